@@ -5,6 +5,7 @@ import sys
 import traceback
 
 from db_mongo import DB_Handler
+from reference_cache import ReferenceCache
 
 st.set_page_config(layout = "wide")
 
@@ -35,11 +36,19 @@ except Exception as e:
 
 @st.cache_resource
 def load_db():
-    return DB_Handler()
+    db = DB_Handler()
+    db.start_warm_up()
+    return db
+
+
+@st.cache_resource
+def load_reference_cache(_db):
+    return ReferenceCache(_db, collections = ('tools', 'users'))
 
 try:
     db = load_db()
     st.session_state['db'] = db
+    st.session_state['reference_cache'] = load_reference_cache(db)
 except pymongo.errors.ConfigurationError as e:
     traceback.print_exc()
     print('Check the mongodb cluster is active')
@@ -73,6 +82,11 @@ if st.session_state.get('authentication_status'):
             title = 'Users',
             icon = ":material/account_circle:"
         ),
+        st.Page(
+            "./pages/diagnostics.py",
+            title = 'Diagnostics',
+            icon = ":material/monitoring:"
+        ),
         st.Page(
             "pages/settings.py",
             title = 'Settings',
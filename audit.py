@@ -0,0 +1,128 @@
+import math
+import datetime
+
+import pymongo
+import pymongo.errors
+from bson.objectid import ObjectId
+
+
+class AuditLog():
+	INDEXES = [
+		[('collection', 1), ('doc_id', 1), ('when', -1)], # page, last_updated
+		[('collection', 1), ('_id', -1)], # newest entry of a collection, ReferenceCache.signal
+	]
+
+	def __init__(self, db, collection_name = 'history', ttl_days = None, capped_bytes = None, page_size = 20):
+		"""
+		change history of documents in other collections, one document per change:
+			{collection, doc_id, what, when, who}
+		db: pymongo database
+		ttl_days: if set, entries older than this are expired by mongodb, ignored if the collection is capped
+		capped_bytes: if set, a new history collection is created capped at this size
+		"""
+		self.db = db
+		self.name = collection_name
+		self.ttl_days = ttl_days
+		self.capped_bytes = capped_bytes
+		self.page_size = page_size
+		self.collection = db[collection_name]
+		return
+
+	def ensure_indexes(self):
+		""" idempotent, safe to run at every startup """
+		if self.capped_bytes and self.name not in self.db.list_collection_names():
+			try:
+				self.db.create_collection(self.name, capped = True, size = int(self.capped_bytes))
+			except pymongo.errors.CollectionInvalid:
+				pass # created in the meantime
+		for keys in self.INDEXES:
+			self.collection.create_index(keys)
+		if self.ttl_days and self.collection.options().get('capped'):
+			# mongodb has no ttl on capped collections, the cap bounds the history instead
+			print('history is capped, ttl_days', self.ttl_days, 'ignored')
+		elif self.ttl_days:
+			try:
+				self.collection.create_index('when', expireAfterSeconds = int(float(self.ttl_days) * 24 * 60 * 60))
+			except pymongo.errors.OperationFailure as e:
+				print('history ttl index', e)
+		return
+
+	def entry(self, collection, doc_id, what, who = None, when = None):
+		e = {
+			'collection': collection,
+			'doc_id': ObjectId(doc_id),
+			'what': what,
+			'when': when or datetime.datetime.now()
+		}
+		if who:
+			e['who'] = who
+		return e
+
+	def record(self, collection, doc_id, what, who = None):
+		self.collection.insert_one(self.entry(collection, doc_id, what, who))
+		return
+
+	def record_many(self, entries):
+		if entries:
+			self.collection.insert_many(entries, ordered = False)
+		return
+
+	def query(self, collection, doc_id):
+		return {'collection': collection, 'doc_id': ObjectId(doc_id)}
+
+	def pages(self, collection, doc_id):
+		n = self.collection.count_documents(self.query(collection, doc_id))
+		return max(1, math.ceil(n / self.page_size))
+
+	def page(self, collection, doc_id, page = 0):
+		""" one page of a document's history, newest first """
+		cursor = self.collection.find(self.query(collection, doc_id), {'_id': 0}) \
+			.sort('when', pymongo.DESCENDING) \
+			.skip(page * self.page_size) \
+			.limit(self.page_size)
+		return list(cursor)
+
+	def last_updated(self, collection):
+		"""
+		{str(doc_id): time of the latest change} for the documents of collection
+		sorted like the (collection, doc_id, when) index so $first reads one entry per document from it
+		"""
+		pipeline = [
+			{'$match': {'collection': collection}},
+			{'$sort': {'collection': 1, 'doc_id': 1, 'when': -1}},
+			{'$group': {'_id': '$doc_id', 'when': {'$first': '$when'}}}
+		]
+		return {str(r['_id']): r['when'] for r in self.collection.aggregate(pipeline)}
+
+	def migrate_embedded(self, collection):
+		"""
+		move the history arrays embedded in the documents of collection to this log
+		safe to rerun, entries already logged on (collection, doc_id, when) are skipped
+		only inserts, so a capped history collection works too
+		returns the number of entries moved
+		"""
+		n = 0
+		for doc in self.db[collection].find({'history.0': {'$exists': True}}, {'history': 1}):
+			logged = {e['when'] for e in self.collection.find(self.query(collection, doc['_id']), {'when': 1})}
+			entries = list()
+			for h in doc['history']:
+				e = self.entry(collection, doc['_id'], h.get('what'), h.get('who'), h.get('when'))
+				if e['when'] not in logged:
+					logged.add(e['when'])
+					entries.append(e)
+			self.record_many(entries)
+			self.db[collection].update_one({'_id': doc['_id']}, {'$unset': {'history': ''}})
+			n += len(entries)
+
+		# empty arrays left
+		self.db[collection].update_many({'history': {'$exists': True}}, {'$unset': {'history': ''}})
+		print('migrate_embedded', collection, n, 'history entries')
+		return n
+
+
+if __name__ == '__main__':
+	from db_mongo import DB_Handler
+
+	dbh = DB_Handler()
+	for collection in ['tools', 'users']:
+		dbh.audit.migrate_embedded(collection)
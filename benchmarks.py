@@ -0,0 +1,314 @@
+"""
+benchmarks for the slow paths of the app
+run all with: python benchmarks.py
+or some with: python benchmarks.py list_dataloggers
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+
+
+def timed(func, *args, repeat = 3, **kwargs):
+    """ returns (best time in seconds, result of the last call) """
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+def random_datalogger_id(rng):
+    return '-'.join(f'{rng.randrange(256):02X}' for _ in range(6))
+
+
+# ----- list_dataloggers
+
+class FakeBlob():
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeBlobIterator():
+    """ mimics google.api_core.page_iterator.HTTPIterator: pages, items and prefixes filled as pages load """
+    def __init__(self, names, prefixes, page_size, page_latency_s):
+        self.names = names
+        self.all_prefixes = sorted(prefixes)
+        self.page_size = page_size
+        self.page_latency_s = page_latency_s
+        self.prefixes = set()
+
+    @property
+    def pages(self):
+        n = max(len(self.names), len(self.all_prefixes))
+        for start in range(0, max(n, 1), self.page_size):
+            time.sleep(self.page_latency_s) # one round trip per page
+            self.prefixes.update(self.all_prefixes[start:start + self.page_size])
+            yield [FakeBlob(name) for name in self.names[start:start + self.page_size]]
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from page
+
+
+class FakeBucket():
+    def __init__(self, names, page_size = 1000, page_latency_s = 0.0):
+        self.names = sorted(names)
+        self.page_size = page_size
+        self.page_latency_s = page_latency_s
+
+    def list_blobs(self, prefix = '', delimiter = None, max_results = None):
+        names = [n for n in self.names if n.startswith(prefix)]
+        prefixes = set()
+        if delimiter:
+            top_level = list()
+            for n in names:
+                head, sep, tail = n[len(prefix):].partition(delimiter)
+                if sep:
+                    prefixes.add(prefix + head + delimiter)
+                else:
+                    top_level.append(n)
+            names = top_level
+        return FakeBlobIterator(names[:max_results], prefixes, self.page_size, self.page_latency_s)
+
+
+def legacy_list_dataloggers(bkt):
+    """ data_from_cloud.list_dataloggers before the prefix listing, full bucket scan """
+    blobs = bkt.list_blobs()
+    ids = []
+    for blob in blobs:
+        id = blob.name.split('/')[0]
+        if len(id) != 17:
+            continue
+        if id in ids:
+            continue
+        ids.append(id)
+    return ids
+
+
+def benchmark_list_dataloggers(n_blobs = 100_000, n_dataloggers = 300, page_latency_s = 0.02):
+    import data_from_cloud
+
+    rng = random.Random(0)
+    ids = [random_datalogger_id(rng) for _ in range(n_dataloggers)]
+    names = [f'{rng.choice(ids)}/events/{770000000 + i}.csv' for i in range(n_blobs)]
+    names += ['readme.txt', 'firmware/v6.bin']
+    bkt = FakeBucket(names, page_latency_s = page_latency_s)
+    print(f'list_dataloggers: {n_blobs} blobs, {n_dataloggers} dataloggers, {page_latency_s * 1000:.0f} ms per page')
+
+    t_old, old = timed(legacy_list_dataloggers, bkt, repeat = 1)
+    t_new, new = timed(data_from_cloud.list_dataloggers, bkt = bkt)
+    assert sorted(old) == new, 'prefix listing differs from the full scan'
+
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot_filename = os.path.join(tmp, 'dataloggers.json')
+        data_from_cloud.list_dataloggers(snapshot_ttl_s = 60, snapshot_filename = snapshot_filename, bkt = bkt)
+        t_snap, snap = timed(data_from_cloud.list_dataloggers, snapshot_ttl_s = 60, snapshot_filename = snapshot_filename, bkt = bkt)
+    assert snap == new
+
+    print(f'  full scan        {t_old:9.3f} s')
+    print(f'  prefix listing   {t_new:9.3f} s  ({t_old / t_new:.0f}x)')
+    print(f'  snapshot         {t_snap:9.4f} s')
+    return
+
+
+# ----- events_list_summarized
+
+def fake_events_df(n_events, seed = 0):
+    """ events like events_df_by_id_and_date_range, about 10 events per session """
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    duration = rng.uniform(1, 60, n_events).round(1)
+    gap = np.where(rng.random(n_events) < 0.1, rng.uniform(300, 3600, n_events), rng.uniform(0, 60, n_events))
+    timestamp = (1.72e9 + np.cumsum(duration + gap)).astype('int64')
+    return pd.DataFrame({
+        'datalogger': '10-06-1C-30-10-14',
+        'filename': [f'10-06-1C-30-10-14/events/{t - 946684800}.csv' for t in timestamp],
+        'timestamp': timestamp,
+        'duration': duration,
+        'avgCurrent': rng.normal(5, 10, n_events),
+        'energy': rng.uniform(0, 20, n_events),
+        'date': pd.to_datetime(timestamp, unit = 's').date
+    })
+
+
+def legacy_events_list_summarized(dfs, timezone):
+    """ event.events_list_summarized before the groupby rewrite, one concat per session """
+    import pandas as pd
+    import functions
+
+    df = pd.DataFrame()
+    for dfi in dfs:
+        if dfi.empty:
+            continue
+        duration_sum = dfi['duration'].sum()
+        start_timestamp = dfi['timestamp'].min()
+        row = pd.DataFrame([{
+            'Time (local)': functions.timestamp_to_local_time(start_timestamp, timezone),
+            'Timezone': timezone,
+            'timestamp': start_timestamp,
+            'Duration': functions.seconds_to_string(duration_sum),
+            'Duration (s)': duration_sum,
+            'Energy (Wh)': dfi['energy'].sum(),
+            'date': dfi['date'].iloc[0],
+            'filenames': dfi['filename'].tolist()
+        }])
+        df = pd.concat([df, row], ignore_index = True)
+    return df
+
+
+def legacy_summarize(df, timezone, timeout_s):
+    """ event.combine_adjacent_events and split_events_by_charging before label_sessions, lists of slices """
+    import numpy as np
+    import pandas as pd
+
+    df = df.copy()
+    df['end_timestamp'] = df['timestamp'] + df['duration']
+    df['time_to_next'] = pd.to_numeric(df['timestamp'].shift(-1) - df['end_timestamp']).fillna(60 * 60 * 24)
+    idx = np.append([0], np.where(df['time_to_next'] > timeout_s))
+    dfs = [df.iloc[idx[n] + 1:idx[n + 1] + 1] for n in range(len(idx) - 1)]
+
+    dfs_r = list()
+    for dfi in dfs:
+        dfi = dfi.copy()
+        dfi['charging'] = (dfi['avgCurrent'] < 0)
+        for name, data in dfi.groupby('charging'):
+            dfs_r.append(data)
+    return legacy_events_list_summarized(dfs_r, timezone)
+
+
+def benchmark_events_list_summarized(sizes = (1_000, 10_000, 100_000), timezone = 'US/Central', timeout_s = 120):
+    import event
+
+    print('events_list_summarized')
+    for n in sizes:
+        df = fake_events_df(n)
+        t_old, old = timed(legacy_summarize, df, timezone, timeout_s, repeat = 1)
+        t_new, new = timed(event.summarize_events, df, timezone, timeout_s)
+        print(f'  {n:7d} events, {len(new):6d} rows   loop {t_old:8.3f} s   groupby {t_new:7.3f} s  ({t_old / t_new:.0f}x)')
+    return
+
+
+# ----- downsample
+
+def fake_trace(n_samples, n_sessions = 6, rate_hz = 1000, gap_s = 1800, seed = 0):
+    """ a day of event files concatenated like pages/home.py, sessions at rate_hz separated by gap_s """
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    per_session = n_samples // n_sessions
+    t = np.concatenate([1.72e9 + s * gap_s + np.arange(per_session) / rate_hz for s in range(n_sessions)])
+    current = rng.normal(10, 2, len(t))
+    dips = rng.random(len(t)) < 1e-4
+    current[dips] = -40 # short dips the max resample hides
+    return pd.DataFrame({
+        't (s)': t,
+        'time': pd.to_datetime(t, unit = 's', utc = True),
+        'current (A)': current,
+        'voltage (V)': rng.normal(54, 0.5, len(t))
+    })
+
+
+def legacy_resample_loop(df, plot_vars, max_num_points = 1.0e5):
+    """ the plotting block of pages/home.py before downsample.py, resample().max() with the rate bumped 0.1s at a time """
+    import pandas as pd
+
+    df_resample = df
+    resample_rate_override = 'Original'
+    while df_resample['t (s)'].size * len(plot_vars) > max_num_points:
+        if not isinstance(resample_rate_override, float):
+            resample_rate_override = 0.0
+        resample_rate_override = round(float(resample_rate_override) + 0.1, 2)
+        df_resample = df.copy()
+        df_resample['timedelta'] = pd.to_timedelta(df['t (s)'], unit = 's')
+        df_resample = df_resample.resample(f'{float(resample_rate_override)}s', on = 'timedelta').max()
+    return df_resample
+
+
+def benchmark_downsample(sizes = (600_000, 1_000_000, 3_000_000), plot_vars = ('current (A)', 'voltage (V)'), max_points = 100_000):
+    import downsample
+
+    print(f'downsample to {max_points:.0e} points,', len(plot_vars), 'variables')
+    for n in sizes:
+        df = fake_trace(n)
+        n_dips = int((df['current (A)'] < -30).sum())
+        t_old, old = timed(legacy_resample_loop, df, list(plot_vars), repeat = 1)
+        t_mm, (mm, mm_width) = timed(downsample.downsample, df, 't (s)', list(plot_vars), max_points, mode = 'minmax')
+        t_lttb, (lttb, _) = timed(downsample.downsample, df, 't (s)', list(plot_vars), max_points, mode = 'lttb', repeat = 1)
+        for name, rows in [('minmax', mm), ('lttb', lttb)]:
+            fill = len(rows) * len(plot_vars) / max_points
+            # the sessions are separated by idle gaps, the budget must still be used
+            assert downsample.FILL <= fill <= 1, f'{name} used {fill:.1%} of the point budget'
+        print(f'  {n:9d} samples, {n_dips} dips')
+        print(f'    resample loop {t_old:8.3f} s  {len(old):7d} rows  {int((old["current (A)"] < -30).sum()):5d} dips kept')
+        print(f'    minmax        {t_mm:8.3f} s  {len(mm):7d} rows  {int((mm["current (A)"] < -30).sum()):5d} dips kept  ({t_old / t_mm:.0f}x)  buckets {mm_width:.3f} s')
+        print(f'    lttb          {t_lttb:8.3f} s  {len(lttb):7d} rows  {int((lttb["current (A)"] < -30).sum()):5d} dips kept')
+    return
+
+
+# ----- charts
+
+def legacy_event_figures(df, plot_df, plot_vars, vline_xs):
+    """ the figures of pages/home.py before charts.py: add_scatter, add_vline per event, px.histogram over the raw frame """
+    import math
+    import plotly.graph_objs
+    import plotly.express as px
+
+    fig = plotly.graph_objs.Figure()
+    for plot_var in plot_vars:
+        fig.add_scatter(x = plot_df['time'], y = plot_df[plot_var], name = plot_var, mode = 'lines')
+    for x in vline_xs:
+        fig.add_vline(x = x, line_width = 1, line_dash = "dot", line_color = "#dbdbdb")
+    fig.update_xaxes(tickformat = '%I:%M:%S %p')
+
+    y_var = plot_vars[0]
+    nbins = math.ceil((df[y_var].max() - df[y_var].min()) / 5)
+    hist = px.histogram(df, y = 'dt (s)', x = y_var, marginal = 'box', nbins = nbins)
+    return fig, hist
+
+
+def new_event_figures(df, plot_df, plot_vars, vline_xs):
+    import charts
+
+    fig = charts.figure(
+        [charts.scatter(x = plot_df['time'], y = plot_df[plot_var], name = plot_var) for plot_var in plot_vars],
+        shapes = charts.vlines(vline_xs),
+        xaxis = {'tickformat': '%I:%M:%S %p'}
+    )
+    hist = charts.histogram(df[plot_vars[0]], weights = df['dt (s)'], bin_width = 5, x_title = plot_vars[0], y_title = 'sum of dt (s)')
+    return fig, hist
+
+
+def benchmark_charts(n_samples = 1_000_000, n_plot_points = 50_000, n_events = 60, plot_vars = ('current (A)', 'voltage (V)')):
+    """ figure build time, and the json sent to the browser """
+    df = fake_trace(n_samples)
+    df['dt (s)'] = df['t (s)'].diff().fillna(0).clip(lower = 0)
+    plot_df = df.iloc[::max(1, n_samples // n_plot_points)]
+    vline_xs = df['time'].iloc[::max(1, n_samples // n_events)].tolist()
+
+    print(f'charts: {n_samples} samples, {len(plot_df)} plotted per variable, {len(vline_xs)} event lines')
+    for name, build in [('add_scatter/add_vline/px', legacy_event_figures), ('charts', new_event_figures)]:
+        t_build, (fig, hist) = timed(build, df, plot_df, list(plot_vars), vline_xs, repeat = 1)
+        t_json, payload = timed(lambda: len(fig.to_json()) + len(hist.to_json()), repeat = 1)
+        print(f'  {name:26s} build {t_build:7.3f} s   to_json {t_json:7.3f} s   payload {payload / 1e6:8.2f} MB')
+    return
+
+
+BENCHMARKS = {
+    'list_dataloggers': benchmark_list_dataloggers,
+    'events_list_summarized': benchmark_events_list_summarized,
+    'downsample': benchmark_downsample,
+    'charts': benchmark_charts,
+}
+
+
+if __name__ == '__main__':
+    selected = sys.argv[1:] or list(BENCHMARKS)
+    for name in selected:
+        BENCHMARKS[name]()
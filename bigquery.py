@@ -1,154 +1,437 @@
 from google.cloud import bigquery
 from google.oauth2 import service_account
+import sys
 import time
-import copy
+import datetime
+import collections
 from memoization import cached
 import streamlit as st
 
+import functions
+
 #from db_mongo import DB_Handler
 
 table = "events"
-dataset = st.secrets['bigquery_dataset']
-project_id = st.secrets['bigquery_project_id']
-table_id = ".".join([project_id, dataset, table])
-gcp_credentials = service_account.Credentials.from_service_account_info(
-	st.secrets["gcp_service_account"]
-)
+client = None # created by get_client on first use, or set to a bigquery_fake.FakeClient offline
 
-client = bigquery.Client(
-	project = project_id,
-	credentials = gcp_credentials
-)
 
+def get_client():
+	global client
+	if client is None:
+		gcp_credentials = service_account.Credentials.from_service_account_info(
+			st.secrets["gcp_service_account"]
+		)
+		client = bigquery.Client(
+			project = st.secrets['bigquery_project_id'],
+			credentials = gcp_credentials
+		)
+	return client
+
+
+def table_name(table = 'events'):
+	""" project.dataset.table """
+	return ".".join([st.secrets['bigquery_project_id'], st.secrets['bigquery_dataset'], table])
+
+
+# column types for query parameters, when the python value alone is ambiguous (e.g. '2024-06-09')
+COLUMN_TYPES = {
+	'date': 'DATE'
+}
+
+OPERATORS = ('=', '!=', '<>', '<', '<=', '>', '>=', 'LIKE', 'IN')
+
+# most bytes a query may bill before BigQuery fails it, by call site
+# override in secrets with a [bigquery_maximum_bytes_billed] table of site = bytes
+MAXIMUM_BYTES_BILLED = {
+	'default': 20 * 1024 ** 3,
+}
 
-def query(statement):
-	""" general query, call with direct SQL statement string """
-	request = client.query(statement)
-	return request.result()
+# dry run estimates above this are confirmed in the app before running
+LARGE_SCAN_BYTES = 1024 ** 3
+
+# latest query metrics, newest last, for the diagnostics page
+query_metrics = collections.deque(maxlen = 200)
+
+
+class QueryTooLarge(ValueError):
+	pass
+
+
+def parameter_type(value, column = None):
+	if column in COLUMN_TYPES:
+		return COLUMN_TYPES[column]
+	if isinstance(value, bool):
+		return 'BOOL'
+	if isinstance(value, int):
+		return 'INT64'
+	if isinstance(value, float):
+		return 'FLOAT64'
+	if isinstance(value, datetime.datetime):
+		return 'TIMESTAMP'
+	if isinstance(value, datetime.date):
+		return 'DATE'
+	return 'STRING'
+
+
+def query_parameters(params):
+	"""
+	params: list of (name, type, value) like ('start_date', 'DATE', '2024-06-09')
+	a list or tuple value becomes an ARRAY of type
+	"""
+	qps = list()
+	for name, type_, value in params:
+		if isinstance(value, (list, tuple)):
+			qps.append(bigquery.ArrayQueryParameter(name, type_, list(value)))
+			continue
+		if type_ == 'DATE' and isinstance(value, datetime.datetime):
+			value = value.date()
+		qps.append(bigquery.ScalarQueryParameter(name, type_, value))
+	return qps
+
+
+def maximum_bytes_billed(site = 'default'):
+	limits = dict(MAXIMUM_BYTES_BILLED)
+	limits.update(functions.secret('bigquery_maximum_bytes_billed', {}))
+	return int(limits.get(site, limits['default']))
+
+
+def record_metrics(job, statement, site, latency_s, dry_run = False):
+	print('query', site, 'cache_hit', job.cache_hit, 'bytes processed', job.total_bytes_processed)
+	query_metrics.append({
+		'when': datetime.datetime.now(),
+		'site': site,
+		'dry run': dry_run,
+		'latency (s)': round(latency_s, 3),
+		'bytes processed': job.total_bytes_processed,
+		'bytes billed': job.total_bytes_billed,
+		'slot ms': job.slot_millis,
+		'cache hit': job.cache_hit,
+		'query': statement
+	})
+	return
 
 
-def update(table, statement):
+@st.cache_data(ttl = 5*60, show_spinner = False)
+def estimate_bytes(statement, params = None, site = 'default'):
+	""" dry run, returns the bytes the query would process without running it """
+	job_config = bigquery.QueryJobConfig(
+		query_parameters = query_parameters(params or []),
+		dry_run = True,
+		use_query_cache = False
+	)
+	t0 = time.time()
+	request = get_client().query(statement, job_config = job_config)
+	record_metrics(request, statement, site, time.time() - t0, dry_run = True)
+	return request.total_bytes_processed
+
+
+def query(statement, params = None, site = 'default', dry_run_first = False):
+	"""
+	general query, call with direct SQL statement string and (name, type, value) parameters for @name
+	site: call site name, selects the maximum_bytes_billed limit and labels the metrics
+	dry_run_first: estimate first and raise QueryTooLarge instead of starting a query over the limit
+	"""
+	limit = maximum_bytes_billed(site)
+	if dry_run_first:
+		estimate = estimate_bytes(statement, params, site)
+		if estimate > limit:
+			raise QueryTooLarge(f'{site} would process {estimate} bytes, limit {limit}')
+
+	job_config = bigquery.QueryJobConfig(
+		query_parameters = query_parameters(params or []),
+		maximum_bytes_billed = limit
+	)
+	t0 = time.time()
+	request = get_client().query(statement, job_config = job_config)
+	rows = request.result()
+	record_metrics(request, statement, site, time.time() - t0)
+	return rows
+
+
+def update(table, statement, params = None, site = 'default'):
 	q = (
-		f"UPDATE {project_id}.{dataset}.{table} "
+		f"UPDATE {table_name(table)} "
 		f"{statement}"
 	)
-	return query(q)
+	return query(q, params, site)
 
 
 @cached(ttl=60*5)
 def list_dataloggers(date_range = None):
 	qu = (
 			'SELECT `datalogger` '
-			'FROM `' + table_id + '` '
+			'FROM `' + table_name() + '` '
 	)
+	params = list()
 	if date_range:
 		qu += (
-			f"WHERE `date` BETWEEN '{date_range[0].strftime('%Y-%m-%d')}' AND '{date_range[1].strftime('%Y-%m-%d')}' "
+			"WHERE `date` BETWEEN @start_date AND @end_date "
 		)
+		params = [
+			('start_date', 'DATE', date_range[0].strftime('%Y-%m-%d')),
+			('end_date', 'DATE', date_range[1].strftime('%Y-%m-%d'))
+		]
 	qu += (
 			'GROUP BY 1 '
 			'ORDER BY `datalogger` '
 	)
-	print('query ', qu)
-	rows = query(qu)
+	print('query ', qu, params)
+	rows = query(qu, params, site = 'list_dataloggers')
 	ids = [r['datalogger'] for r in rows]
 	return ids
 
 
-def insert_bigquery(row_to_insert, table = 'events'):
+def build_find(select, where = None, order = None, table = 'events', limit = None):
 	"""
-	Insert a single row to bigquery
+	returns (sql, params) for find
+	values are passed as parameters @w0, @w1, ... so the same query shape always has the same text
+	where: list of (column, operator, value), IN takes a list of values
 	"""
-	table_id = ".".join([project_id, dataset, table])
-
-	errors = client.insert_rows_json(
-		table_id, [row_to_insert]
-		#, row_ids = [None] * len(rows_to_insert)
-	)
-	if not errors:
-		return True
-	else:
-		print("Encountered errors while inserting rows: {}".format(errors))
-		return False
-	return
-
-
-def find(select, where = None, order = None, table = 'events', limit = None):
-	schema = {
-		'date': 'DATE'
-	}
 	select_text = ', '.join(['`' + str(v) + '`' for v in select])
 	select_text = select_text.replace('`*`', '*')
 
-	table_id = ".".join([project_id, dataset, table])
+	table_id = table_name(table)
 
 	query = f"SELECT {select_text} FROM `{table_id}` "
+	params = list()
 	if where:
-		where_txt = " AND ".join(['`' + str(k) + '` ' + str(c) + ' "' + str(v) + '"' for k, c, v in where])
+		conditions = list()
+		for i, (k, c, v) in enumerate(where):
+			c = str(c).upper()
+			if c not in OPERATORS:
+				raise ValueError(f'find operator not supported: {c}')
+			name = f'w{i}'
+			if c == 'IN':
+				v = tuple(v)
+				conditions.append(f'`{k}` IN UNNEST(@{name})')
+				params.append((name, parameter_type(v[0] if v else None, k), v))
+			else:
+				conditions.append(f'`{k}` {c} @{name}')
+				params.append((name, parameter_type(v, k), v))
+		where_txt = " AND ".join(conditions)
 		query += f'WHERE {where_txt} '
 	if order:
 		order_text = ', '.join(['`' + str(v) + '` ' + str(d) for v, d in order])
 		query += f'ORDER BY {order_text} '
 	if limit:
-		query += f'LIMIT {int(limit)}'
+		query += 'LIMIT @limit'
+		params.append(('limit', 'INT64', int(limit)))
+	return query, params
 
-	print('query ', query)
-	query_job = client.query(query)  # API request
-	rows = query_job.result()
-	return rows
+
+def find(select, where = None, order = None, table = 'events', limit = None, site = 'default'):
+	statement, params = build_find(select, where, order, table, limit)
+	print('query ', statement, params)
+	return query(statement, params, site)
+
+
+def guarded_query(q, params = None, site = 'default'):
+	"""
+	df_from_query for the pages: dry run first, ask before large scans and refuse scans over the site limit
+	stops the page run while a large scan is not confirmed
+	"""
+	estimate = estimate_bytes(q, params, site)
+	limit = maximum_bytes_billed(site)
+	if estimate > limit:
+		st.error(f'This query would scan {functions.bytes_to_string(estimate)}, over the {functions.bytes_to_string(limit)} limit. Narrow the date range.')
+		st.stop()
+	if estimate > LARGE_SCAN_BYTES:
+		st.warning(f'This query will scan {functions.bytes_to_string(estimate)}')
+		if not st.checkbox('Run anyway', key = f'confirm-{site}'):
+			st.stop()
+	return df_from_query(q, params, site)
 
 
 @st.cache_data(ttl = 5*60, show_spinner = True, show_time = True)
-def df_from_query(q):
-	query_job = client.query(q)  # API request
-	rows = query_job.result()
+def df_from_query(q, params = None, site = 'default'):
+	"""
+	q: SQL with @name placeholders
+	params: (name, type, value) tuples, e.g. (('start_date', 'DATE', start_date),)
+	"""
+	rows = query(q, params, site)
 	return rows.to_dataframe()
 
 
-def migrate_mongodb_to_bigquery(datalogger_id, limit = 1):
+def insert_rows(rows, row_ids, table = 'events'):
+	"""
+	streaming insert of many rows in one request
+	row_ids are sent as insertId so bigquery drops rows retried within its dedup window
+	returns the set of indexes of rows that failed
+	"""
+	table_id = table_name(table)
+	errors = get_client().insert_rows_json(table_id, rows, row_ids = row_ids)
+	if errors:
+		print("Encountered errors while inserting rows: {}".format(errors))
+	return {e['index'] for e in errors}
+
+
+def load_dataframe(df, table, schema, write_disposition = 'WRITE_TRUNCATE'):
+	"""
+	batch load a dataframe into a table, one load job instead of streaming or DML
+	schema: list of (column, type)
+	"""
+	table_id = table_name(table)
+	job_config = bigquery.LoadJobConfig(
+		schema = [bigquery.SchemaField(name, type_) for name, type_ in schema],
+		write_disposition = write_disposition
+	)
+	job = get_client().load_table_from_dataframe(df, table_id, job_config = job_config)
+	job.result()
+	print('load_dataframe', len(df.index), 'rows to', table_id)
+	return table_id
+
+
+ROLLUP_TABLE = 'events_daily'
+
+# per (datalogger, date) sums, shared by the rollup job and the raw events fallback
+DAILY_COLUMNS = (
+	'CAST(SUM(duration) AS FLOAT64) AS sum_duration, '
+	'CAST(SUM(CASE WHEN avgCurrent >= 0 THEN energy ELSE 0 END) AS FLOAT64) AS discharged_wh, '
+	'CAST(SUM(CASE WHEN avgCurrent < 0 THEN energy ELSE 0 END) AS FLOAT64) AS charged_wh, '
+	'COUNT(*) AS n_events '
+)
+
+
+def create_rollup_table():
+	statement = (
+		f'CREATE TABLE IF NOT EXISTS `{table_name(ROLLUP_TABLE)}` ('
+		'datalogger STRING, date DATE, '
+		'sum_duration FLOAT64, discharged_wh FLOAT64, charged_wh FLOAT64, n_events INT64, '
+		'updated TIMESTAMP'
+		') '
+		'PARTITION BY date '
+		'CLUSTER BY datalogger'
+	)
+	return query(statement, site = 'rollup')
+
+
+@cached(ttl = 60*5)
+def rollup_through():
+	""" last date in the rollup, None if it is empty or missing """
+	try:
+		rows = query(f'SELECT MAX(date) AS d FROM `{table_name(ROLLUP_TABLE)}`', site = 'rollup')
+	except Exception as e:
+		print('rollup_through', e)
+		return None
+	return next(iter(rows))['d']
+
+
+def update_rollup(start_date = None, end_date = None, days_back = 3):
+	"""
+	(re)build the events_daily rows of start_date to end_date from events with one MERGE
+	by default the last days_back rolled up days again, for late events, through yesterday
+	today is left out, the app reads the partial day from events
+	"""
+	create_rollup_table()
+	end_date = end_date or datetime.date.today() - datetime.timedelta(days = 1)
+	if start_date is None:
+		rollup_through.cache_clear()
+		last = rollup_through()
+		start_date = last - datetime.timedelta(days = days_back) if last else datetime.date(2000, 1, 1)
+
+	statement = (
+		f'MERGE `{table_name(ROLLUP_TABLE)}` T '
+		'USING ('
+		f'SELECT datalogger, date, {DAILY_COLUMNS}'
+		f'FROM `{table_name()}` '
+		'WHERE date BETWEEN @start_date AND @end_date '
+		'GROUP BY datalogger, date'
+		') S '
+		'ON T.datalogger = S.datalogger AND T.date = S.date '
+		'WHEN MATCHED THEN UPDATE SET '
+		'sum_duration = S.sum_duration, discharged_wh = S.discharged_wh, charged_wh = S.charged_wh, '
+		'n_events = S.n_events, updated = CURRENT_TIMESTAMP() '
+		'WHEN NOT MATCHED BY TARGET THEN INSERT (datalogger, date, sum_duration, discharged_wh, charged_wh, n_events, updated) '
+		'VALUES (S.datalogger, S.date, S.sum_duration, S.discharged_wh, S.charged_wh, S.n_events, CURRENT_TIMESTAMP()) '
+		'WHEN NOT MATCHED BY SOURCE AND T.date BETWEEN @start_date AND @end_date THEN DELETE'
+	)
+	params = (('start_date', 'DATE', start_date), ('end_date', 'DATE', end_date))
+	print('update_rollup', start_date, 'to', end_date)
+	query(statement, params, site = 'rollup')
+	rollup_through.cache_clear()
+	return start_date, end_date
+
+
+def daily_usage(where = ''):
+	"""
+	SQL of a `daily` CTE with the columns datalogger, date, sum_duration, discharged_wh, charged_wh, n_events
+	for the dates @start_date to @end_date, read from the rollup where it has them and from events after that
+	where: extra condition for both, e.g. 'AND datalogger = @datalogger'
+	returns (sql, params), params has @rollup_through to add to the caller's
+	"""
+	through = rollup_through()
+	raw = (
+		f'SELECT datalogger, date, {DAILY_COLUMNS}'
+		f'FROM `{table_name()}` '
+		f'WHERE date BETWEEN @start_date AND @end_date AND date > @rollup_through {where} '
+		'GROUP BY datalogger, date'
+	)
+	if through is None:
+		return f'daily AS ({raw})', (('rollup_through', 'DATE', datetime.date(1970, 1, 1)),)
+
+	rolled_up = (
+		'SELECT datalogger, date, sum_duration, discharged_wh, charged_wh, n_events '
+		f'FROM `{table_name(ROLLUP_TABLE)}` '
+		f'WHERE date BETWEEN @start_date AND @end_date AND date <= @rollup_through {where}'
+	)
+	return f'daily AS ({rolled_up} UNION ALL {raw})', (('rollup_through', 'DATE', through),)
+
+
+def migrate_mongodb_to_bigquery(datalogger_id, chunk_size = 500):
+	"""
+	stream a datalogger's unmigrated events from mongodb to bigquery in chunks,
+	one insert_rows_json and one update_many per chunk
+	every chunk is flagged migrated_to_bigquery once inserted, a rerun resumes with the events still unflagged,
+	late events with an older date included
+	once sync_daemon.py has run only events up to its watermark are migrated, the later ones are its own
+	returns the number of rows migrated
+	"""
+	from db_mongo import DB_Handler
+
 	print('migrate_mongodb_to_bigquery', datalogger_id)
 	db = DB_Handler()
+	db.ensure_indexes()
 	query = {'datalogger': datalogger_id, 'migrated_to_bigquery': {'$ne': True}}
-	fields = {'_id': 1, 'data': 0, 'history': 0, 'migrated_to_bigquery': 0}
-
-	count = db.events.count_documents(query)
-	print(count, 'events found')
-	i = 0
-	while count > 0:
-		events = db.events.find(query, fields).limit(limit).sort('date', 1)
+	fields = {'data': 0, 'history': 0, 'migrated_to_bigquery': 0}
+	# events after the sync_daemon watermark are streamed by the daemon, which does not flag them
+	sync_state = db.db.sync_state.find_one({'_id': 'events'})
+	if sync_state and sync_state.get('watermark'):
+		query['_id'] = {'$lte': sync_state['watermark']}
 
-		events = list(events)
-		if len(events) <= 0:
-			return False
+	events = db.events.find(query, fields).sort([('date', 1), ('_id', 1)]).batch_size(chunk_size)
 
-		for e in events:
-			e.update((k, int(v)) for k, v in e.items() if k == 'timestamp')
-			e.update({'time': e['date'].strftime("%H:%M:%S")})
-			e.update({'date': e['date'].strftime("%Y-%m-%d")})
+	n_rows = 0
+	t0 = time.time()
+	for chunk in functions.chunks(events, chunk_size):
+		rows = [functions.event_doc_to_row(e) for e in chunk]
+		failed = insert_rows(rows, row_ids = [str(e['_id']) for e in chunk])
 
-		for e in events:
-			e_without_id = copy.deepcopy(e)
-			del e_without_id['_id']
-			i += 1
-			print(i, 'insert_bigquery', e)
+		migrated_ids = [e['_id'] for i, e in enumerate(chunk) if i not in failed]
+		if migrated_ids:
+			db.events.update_many({'_id': {'$in': migrated_ids}}, {'$set': {'migrated_to_bigquery': True}})
+		n_rows += len(migrated_ids)
 
-			result_bq = insert_bigquery(e_without_id)
-			if result_bq:
-				# db.update('events', str(e['_id']), {'migrated_to_bigquery': True})
-				db.db['events'].update_one({'_id': e['_id']}, {'$set': {'migrated_to_bigquery': True}})
+		if failed:
+			# left unflagged, a rerun retries them
+			print(len(failed), 'rows failed, stopping')
+			break
+		print(n_rows, 'rows migrated', round(n_rows / max(time.time() - t0, 1e-6), 1), 'rows/s')
 
-		count = db.events.count_documents(query)
-
-	return
+	print('migrate_mongodb_to_bigquery', datalogger_id, n_rows, 'rows in', round(time.time() - t0, 1), 's')
+	return n_rows
 
 
 if __name__ == '__main__':
+	if sys.argv[1:2] == ['rollup']:
+		update_rollup()
+		sys.exit()
+
 	#db = DB_Handler()
 	#db.db['events'].update_many({'migrated_to_bigquery': True}, {'$set': {'migrated_to_bigquery': False}})
 
 	#datalogger_ids = list_dataloggers()
 	#for datalogger_id in datalogger_ids:
-		#migrate_mongodb_to_bigquery(datalogger_id, limit = 10)
+		#migrate_mongodb_to_bigquery(datalogger_id, chunk_size = 500)
 		#break
 
 	#result = find(['filename'], [('filename', '=', '24-6F-28-D1-F6-50/events/732192944.csv')])
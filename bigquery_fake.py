@@ -0,0 +1,76 @@
+"""
+local stand-in for google.cloud.bigquery.Client, for running bigquery.py offline
+	import bigquery, bigquery_fake
+	bigquery.client = bigquery_fake.FakeClient(handler = lambda sql, params: [{'datalogger': 'A'}])
+"""
+import json
+
+import pandas as pd
+
+
+class FakeRows():
+	""" the parts of RowIterator the app uses """
+	def __init__(self, rows):
+		self.rows = list(rows)
+		self.total_rows = len(self.rows)
+
+	def __iter__(self):
+		return iter(self.rows)
+
+	def to_dataframe(self):
+		return pd.DataFrame(self.rows)
+
+
+class FakeQueryJob():
+	def __init__(self, rows, cache_hit, total_bytes_processed):
+		self.rows = rows
+		self.cache_hit = cache_hit
+		self.total_bytes_processed = total_bytes_processed
+		self.total_bytes_billed = 0 if cache_hit else total_bytes_processed
+		self.slot_millis = None if cache_hit is None else 0
+
+	def result(self):
+		return FakeRows(self.rows)
+
+
+class FakeClient():
+	def __init__(self, handler = None, bytes_per_query = 0):
+		"""
+		handler(sql, params) -> list of row dicts, params as {name: value}
+		bytes_per_query: reported as total_bytes_processed for every query and dry run
+		"""
+		self.handler = handler or (lambda sql, params: [])
+		self.bytes_per_query = bytes_per_query
+		self.queries = list() # (sql, params, cache_hit)
+		self.inserted = dict() # table_id -> rows
+		self.row_ids = dict() # table_id -> set of row ids
+		self.results_cache = set()
+
+	def query(self, sql, job_config = None):
+		qps = list(job_config.query_parameters) if job_config is not None else []
+		params = {qp.name: getattr(qp, 'value', getattr(qp, 'values', None)) for qp in qps}
+
+		if job_config is not None and job_config.dry_run:
+			self.queries.append((sql, params, None))
+			return FakeQueryJob([], None, self.bytes_per_query)
+
+		# like BigQuery, a cached result needs the exact same text and parameter values
+		key = sql + json.dumps([qp.to_api_repr() for qp in qps], sort_keys = True, default = str)
+		cache_hit = key in self.results_cache
+		self.results_cache.add(key)
+		self.queries.append((sql, params, cache_hit))
+
+		rows = self.handler(sql, params)
+		return FakeQueryJob(rows, cache_hit, 0 if cache_hit else self.bytes_per_query)
+
+	def insert_rows_json(self, table, json_rows, row_ids = None):
+		""" rows with an already seen row id are dropped, like the streaming insertId dedup """
+		rows = self.inserted.setdefault(str(table), list())
+		seen = self.row_ids.setdefault(str(table), set())
+		for i, row in enumerate(json_rows):
+			row_id = row_ids[i] if row_ids else None
+			if row_id is not None and row_id in seen:
+				continue
+			seen.add(row_id)
+			rows.append(row)
+		return []
@@ -0,0 +1,242 @@
+import os
+import time
+import atexit
+import tempfile
+import threading
+from collections import OrderedDict
+
+import google.api_core.exceptions
+
+import functions
+
+
+class BlobCache():
+	def __init__(self, root = 'bucket', max_bytes = 2 * 1024 ** 3, index_filename = '.cache_index.json',
+			derived_suffixes = (), save_interval_s = 30):
+		"""
+		on-disk cache of cloud storage blobs under root
+		root: local directory, same layout as data_from_cloud.server_to_local_filename
+		max_bytes: byte budget, least recently used files are evicted once it is exceeded
+		index_filename: sidecar index of {blob name: generation, size, derived bytes, last access}
+		derived_suffixes: files derived from a cached file (e.g. '.parquet'), counted in its size and removed with it on eviction
+		save_interval_s: how often the index is written, at most, changes since are written by flush
+		"""
+		self.root = root
+		self.max_bytes = max_bytes
+		self.index_filename = os.path.join(root, index_filename)
+		self.derived_suffixes = derived_suffixes
+		self.save_interval_s = save_interval_s
+
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.t_last_save = 0
+		self.dirty = False
+
+		# ordered oldest access first
+		self.index = OrderedDict()
+		entries = functions.load_json(self.index_filename, default = dict())
+		for name, entry in sorted(entries.items(), key = lambda kv: kv[1].get('last_access', 0)):
+			self.index[name] = entry
+		with self.lock:
+			self.scan()
+			self.evict()
+		atexit.register(self.flush)
+		return
+
+	def entry_bytes(self, entry):
+		return entry.get('size', 0) + entry.get('derived', 0)
+
+	def derived_bytes(self, local_filename):
+		n = 0
+		for suffix in self.derived_suffixes:
+			try:
+				n += os.path.getsize(local_filename + suffix)
+			except OSError:
+				pass
+		return n
+
+	def scan(self):
+		"""
+		reconcile the index with the files under root, call with the lock held
+		files downloaded before the index existed are adopted, oldest modified first to go,
+		entries whose file is gone are dropped, derived file sizes are measured
+		"""
+		on_disk = dict()
+		for directory, _, filenames in os.walk(self.root):
+			for filename in filenames:
+				if filename.startswith('.') or filename.endswith(tuple(self.derived_suffixes)):
+					continue # the index, partial downloads, derived files
+				local_filename = os.path.join(directory, filename)
+				name = os.path.relpath(local_filename, self.root).replace(os.sep, '/')
+				on_disk[name] = local_filename
+
+		gone = [name for name in self.index if name not in on_disk]
+		for name in gone:
+			del self.index[name]
+		adopted = sorted((name for name in on_disk if name not in self.index), key = lambda name: os.path.getmtime(on_disk[name]))
+		for name in reversed(adopted):
+			local_filename = on_disk[name]
+			self.index[name] = {
+				'local_filename': local_filename,
+				'generation': None, # unknown, revalidate downloads it again
+				'size': os.path.getsize(local_filename),
+				'last_access': os.path.getmtime(local_filename)
+			}
+			self.index.move_to_end(name, last = False)
+		if adopted:
+			print('blob_cache adopted', len(adopted), 'files')
+		self.refresh_derived()
+		if gone or adopted:
+			self.dirty = True
+		return
+
+	def refresh_derived(self):
+		""" measure the derived files of every entry, written after the download by other modules, call with the lock held """
+		for entry in self.index.values():
+			entry['derived'] = self.derived_bytes(entry['local_filename'])
+		self.total_bytes = sum(self.entry_bytes(e) for e in self.index.values())
+		return
+
+	def fetch(self, blob, local_filename, overwrite = False, revalidate = False):
+		"""
+		return local_filename with the blob contents, downloading only if missing or invalid
+		revalidate: reload the blob metadata and re-download if the generation has changed
+		returns False if the blob does not exist
+		"""
+		if not overwrite and self.is_valid(blob, local_filename, revalidate):
+			with self.lock:
+				entry = self.index.get(blob.name)
+				if entry is not None: # not evicted by another thread in the meantime
+					self.hits += 1
+					entry['last_access'] = time.time()
+					derived = self.derived_bytes(local_filename)
+					self.total_bytes += derived - entry.get('derived', 0)
+					entry['derived'] = derived
+					self.index.move_to_end(blob.name)
+					self.maybe_save_index()
+					return local_filename
+
+		with self.lock:
+			self.misses += 1
+		return self.download(blob, local_filename)
+
+	def is_valid(self, blob, local_filename, revalidate = False):
+		with self.lock:
+			entry = self.index.get(blob.name)
+		if entry is None:
+			return False
+		try:
+			if os.path.getsize(local_filename) != entry['size']:
+				return False
+		except OSError:
+			return False
+		if blob.size is not None and blob.size != entry['size']:
+			return False
+
+		if revalidate:
+			try:
+				blob.reload()
+			except google.api_core.exceptions.NotFound:
+				return False
+			if blob.generation != entry['generation']:
+				print('blob_cache stale generation', blob.name, entry['generation'], '->', blob.generation)
+				return False
+		return True
+
+	def download(self, blob, local_filename):
+		print('downloading ' + blob.name + ' to ' + local_filename)
+		directory = os.path.dirname(local_filename)
+		os.makedirs(directory, exist_ok = True) # create dirs if missing
+
+		# download next to the destination then rename, a partial download never looks valid
+		fd, tmp_filename = tempfile.mkstemp(dir = directory, prefix = '.' + os.path.basename(local_filename), suffix = '.part')
+		os.close(fd)
+		try:
+			blob.download_to_filename(tmp_filename) # verifies the md5 checksum
+			size = os.path.getsize(tmp_filename)
+			if blob.size is not None and size != blob.size:
+				raise IOError(f'incomplete download of {blob.name}, {size} of {blob.size} bytes')
+			os.replace(tmp_filename, local_filename)
+			self.remove_derived(local_filename) # derived from the previous contents
+		except google.api_core.exceptions.NotFound as e:
+			print(time.time(), 'download_blob failed, file not found', blob.name, e)
+			return False
+		finally:
+			if os.path.exists(tmp_filename):
+				os.remove(tmp_filename)
+
+		with self.lock:
+			old = self.index.pop(blob.name, None)
+			if old:
+				self.total_bytes -= self.entry_bytes(old)
+			# the md5 is checked by download_to_filename, hits are checked by size and, on revalidate, generation
+			self.index[blob.name] = {
+				'local_filename': local_filename,
+				'generation': blob.generation,
+				'size': size,
+				'derived': 0,
+				'last_access': time.time()
+			}
+			self.total_bytes += size
+			self.evict()
+			self.maybe_save_index()
+		return local_filename
+
+	def evict(self):
+		""" remove least recently used files until under budget, call with the lock held """
+		while self.total_bytes > self.max_bytes and len(self.index) > 1:
+			name, entry = self.index.popitem(last = False)
+			self.total_bytes -= self.entry_bytes(entry)
+			self.evictions += 1
+			try:
+				os.remove(entry['local_filename'])
+			except FileNotFoundError:
+				pass
+			self.remove_derived(entry['local_filename'])
+			print('blob_cache evicted', name)
+		return
+
+	def remove_derived(self, local_filename):
+		for suffix in self.derived_suffixes:
+			try:
+				os.remove(local_filename + suffix)
+			except FileNotFoundError:
+				pass
+		return
+
+	def save_index(self):
+		""" call with the lock held """
+		functions.save_json(self.index_filename, dict(self.index))
+		self.t_last_save = time.time()
+		self.dirty = False
+		return
+
+	def maybe_save_index(self):
+		""" save at most every save_interval_s, so bulk downloads do not rewrite the index per file, call with the lock held """
+		self.dirty = True
+		if time.time() - self.t_last_save > self.save_interval_s:
+			# derived files written since the last save count toward the budget from now on
+			self.refresh_derived()
+			self.evict()
+			self.save_index()
+		return
+
+	def flush(self):
+		""" write pending index changes """
+		with self.lock:
+			if self.dirty:
+				self.save_index()
+		return
+
+	def stats(self):
+		with self.lock:
+			return {
+				'hits': self.hits,
+				'misses': self.misses,
+				'evictions': self.evictions,
+				'files': len(self.index),
+				'bytes': self.total_bytes,
+				'max_bytes': self.max_bytes
+			}
@@ -0,0 +1,88 @@
+"""
+plotly figures for large event frames
+traces switch to WebGL above GL_THRESHOLD points, vertical lines go in one shapes list,
+and histograms are binned here so only the counts and box statistics are sent to the browser
+"""
+import math
+
+import numpy as np
+import plotly.graph_objs as go
+
+
+GL_THRESHOLD = 5000 # points per trace
+
+
+def scatter(x, y, **kwargs):
+	""" a line trace, Scattergl when it is long """
+	trace = go.Scattergl if len(x) > GL_THRESHOLD else go.Scatter
+	kwargs.setdefault('mode', 'lines')
+	return trace(x = x, y = y, **kwargs)
+
+
+def vlines(xs, color = '#dbdbdb', width = 1, dash = 'dot'):
+	""" shapes for vertical lines across the plot at xs, for layout.shapes """
+	line = {'color': color, 'width': width, 'dash': dash}
+	return [
+		{'type': 'line', 'xref': 'x', 'yref': 'paper', 'x0': x, 'x1': x, 'y0': 0, 'y1': 1, 'line': line}
+		for x in xs
+	]
+
+
+def figure(traces, shapes = (), **layout):
+	""" the whole figure in one constructor call, instead of one validated update per trace and shape """
+	return go.Figure(data = list(traces), layout = dict(layout, shapes = list(shapes)))
+
+
+def bin_values(values, weights = None, bin_width = 5):
+	""" (bin centers, sums of weights or counts) of the finite values, bins aligned to multiples of bin_width """
+	values = np.asarray(values, dtype = 'float64')
+	finite = np.isfinite(values)
+	if weights is not None:
+		weights = np.asarray(weights, dtype = 'float64')
+		finite &= np.isfinite(weights)
+		weights = weights[finite]
+	values = values[finite]
+	if values.size <= 0:
+		return np.array([]), np.array([])
+	low = math.floor(values.min() / bin_width) * bin_width
+	n_bins = max(1, math.ceil((values.max() - low) / bin_width + 1e-9))
+	sums, edges = np.histogram(values, bins = n_bins, range = (low, low + n_bins * bin_width), weights = weights)
+	return edges[:-1] + bin_width / 2, sums
+
+
+def box_stats(values):
+	""" quartiles and 1.5 IQR whiskers of the finite values, for a precomputed go.Box """
+	values = np.asarray(values, dtype = 'float64')
+	values = values[np.isfinite(values)]
+	if values.size <= 0:
+		return None
+	q1, median, q3 = np.percentile(values, [25, 50, 75])
+	iqr = q3 - q1
+	inside = values[(values >= q1 - 1.5 * iqr) & (values <= q3 + 1.5 * iqr)]
+	return {
+		'q1': [q1], 'median': [median], 'q3': [q3],
+		'lowerfence': [inside.min()], 'upperfence': [inside.max()],
+		'mean': [values.mean()]
+	}
+
+
+def histogram(values, weights = None, bin_width = 5, x_title = None, y_title = None):
+	"""
+	histogram with a box plot above it, like px.histogram(marginal = 'box'), from bins computed here
+	weights: summed per bin, e.g. dt (s) for the time spent in each bin, counts when None
+	"""
+	centers, sums = bin_values(values, weights, bin_width)
+	traces = [go.Bar(x = centers, y = sums, width = bin_width, name = x_title, showlegend = False)]
+	stats = box_stats(values)
+	if stats is not None:
+		traces.append(go.Box(
+			y = [x_title or ''], orientation = 'h', xaxis = 'x', yaxis = 'y2',
+			boxpoints = False, showlegend = False, name = x_title, **stats
+		))
+	return figure(
+		traces,
+		xaxis = {'title': {'text': x_title}},
+		yaxis = {'title': {'text': y_title}, 'domain': [0, 0.78]},
+		yaxis2 = {'domain': [0.8, 1], 'anchor': 'x', 'showticklabels': False},
+		bargap = 0
+	)
@@ -1,47 +1,74 @@
 import os
 import time
 import streamlit as st
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import google.api_core.exceptions
 from google.cloud import storage
 from google.oauth2 import service_account
 import itertools
 
+import functions
+from blob_cache import BlobCache
 
-projectID = st.secrets['bigquery_project_id']
-bucketName = st.secrets['google_cloud_storage_bucket_name']
-gcp_credentials = service_account.Credentials.from_service_account_info(
-	st.secrets["gcp_service_account"]
-)
 
-storage_client = storage.Client(
-	projectID,
-	credentials = gcp_credentials
+bucket = None # opened by get_bucket on first use, so importing needs no credentials
+
+
+def get_bucket():
+	global bucket
+	if bucket is None:
+		gcp_credentials = service_account.Credentials.from_service_account_info(
+			st.secrets["gcp_service_account"]
+		)
+		storage_client = storage.Client(
+			st.secrets['bigquery_project_id'],
+			credentials = gcp_credentials
+		)
+		bucket = storage_client.get_bucket(st.secrets['google_cloud_storage_bucket_name'])
+	return bucket
+
+
+blob_cache = BlobCache(
+	root = 'bucket',
+	max_bytes = int(functions.secret('blob_cache_max_bytes', 2 * 1024 ** 3)),
+	derived_suffixes = ('.parquet', '.pyramid.parquet') # event.convert_event_csv, pyramid.read
 )
-bucket = storage_client.get_bucket(bucketName)
+
 
 def list_cloud_files(prefix = ''):
-	blobs = bucket.list_blobs(prefix = prefix)
+	blobs = get_bucket().list_blobs(prefix = prefix)
 	return blobs
 
 
-def list_dataloggers():
+def list_dataloggers(snapshot_ttl_s = None, snapshot_filename = os.path.join('bucket', '.dataloggers.json'), bkt = None):
 	"""
-	list dataloggers based on all files in cloud storage (slow)
+	list dataloggers from the top-level prefixes ("folders") in cloud storage
+	only the prefixes are listed, not every file in the bucket
+	snapshot_ttl_s: if set, reuse the listing saved in snapshot_filename when it is younger than this
+	bkt: bucket to list, defaults to the app bucket
 	"""
-	print('list_dataloggers')
-	blobs = bucket.list_blobs()
-	ids = []
-	for blob in blobs:
-		id = blob.name.split('/')[0]
+	if snapshot_ttl_s:
+		snapshot = functions.load_json(snapshot_filename)
+		if snapshot and time.time() - snapshot['t'] < snapshot_ttl_s:
+			return snapshot['ids']
 
+	print('list_dataloggers')
+	if bkt is None:
+		bkt = get_bucket()
+	blobs = bkt.list_blobs(delimiter = '/')
+	for page in blobs.pages: # prefixes are collected as the pages load
+		pass
+
+	ids = set()
+	for prefix in blobs.prefixes:
+		id = prefix.rstrip('/')
 		# every datalogger ID is 6 bytes (12 chars) plus 5 - separators = 17
-		if len(id) != 17:
-			continue
-		if id in ids:
-			continue
+		if len(id) == 17:
+			ids.add(id)
+	ids = sorted(ids)
 
-		ids.append(id)
+	if snapshot_ttl_s:
+		functions.save_json(snapshot_filename, {'t': time.time(), 'ids': ids})
 	return ids
 
 
@@ -56,34 +83,54 @@ def local_to_server_filename(local_filename):
 
 
 def download_blob_by_name(blob_name):
-	blob = bucket.blob(blob_name)
+	blob = get_bucket().blob(blob_name)
 	return download_blob(blob)
 
 
-def download_blob(blob, overwrite_existing = False):
+def download_blob(blob, overwrite_existing = False, revalidate = False):
+	"""
+	download through the local blob cache
+	revalidate: check the blob generation on the server and re-download if it changed
+	"""
 	if blob.name.endswith('/'): # skip folders
 		return False
 
 	local_filename = server_to_local_filename(blob.name)
+	return blob_cache.fetch(blob, local_filename, overwrite = overwrite_existing, revalidate = revalidate)
 
-	if os.path.isfile(local_filename) and not overwrite_existing:
-		# print(local_filename + ' already exists')
-		return local_filename
-
-	print('downloading ' + blob.name + ' to ' + local_filename)
-	os.makedirs(os.path.dirname(local_filename), exist_ok = True) # create dirs if missing
-	try:
-		print(local_filename)
-		blob.download_to_filename(local_filename)
-	except google.api_core.exceptions.NotFound as e:
-		print(time.time(), 'download_blob failed, file not found', blob.name, e)
-		return False
 
-	return local_filename
+def download_blobs_by_name(blob_names, max_workers = 8):
+	"""
+	download many blobs with a bounded thread pool
+	yields (index, blob_name, local_filename, error) in completion order,
+	index is the position in blob_names so callers can restore the original order
+	error is None on success, otherwise the exception (or False return) for that blob
+	"""
+	with ThreadPoolExecutor(max_workers = max_workers) as pool:
+		futures = {
+			pool.submit(download_blob_by_name, blob_name): (i, blob_name)
+			for i, blob_name in enumerate(blob_names)
+		}
+		try:
+			for future in as_completed(futures):
+				i, blob_name = futures[future]
+				try:
+					local_filename = future.result()
+				except Exception as e:
+					print(time.time(), 'download_blobs_by_name failed', blob_name, e)
+					yield i, blob_name, False, e
+					continue
+				if not local_filename:
+					yield i, blob_name, False, FileNotFoundError(blob_name)
+					continue
+				yield i, blob_name, local_filename, None
+		finally:
+			blob_cache.flush() # the index is saved once for the batch
 
 
 def move_blob(blob_name, destination_blob_name):
 	""" https://cloud.google.com/storage/docs/copying-renaming-moving-objects#storage-move-object-python """
+	bucket = get_bucket()
 	source_blob = bucket.blob(blob_name)
 	blob_copy = bucket.copy_blob(
 		source_blob,
@@ -131,15 +178,13 @@ def upload_google_cloud_storage(source_file_name, destination_blob_name = ''):
 	# source_file_name = "local/path/to/file"
 	# The ID of your GCS object
 	# destination_blob_name = "storage-object-name"
-	global bucketName
-	global storage_client
-	global bucket
 	if destination_blob_name == '':
 		destination_blob_name = source_file_name
 
+	bucket = get_bucket()
 	blob = bucket.blob(destination_blob_name)
 	blob.upload_from_filename(source_file_name)
-	print(destination_blob_name, "uploaded to", bucketName)
+	print(destination_blob_name, "uploaded to", bucket.name)
 
 
 if __name__ == "__main__":
@@ -149,13 +194,4 @@ if __name__ == "__main__":
 	#download_files_by_datalogger_id(id)
 
 
-	blobs = storage_client.list_blobs(
-		bucketName,
-		prefix = "",  # <- you need the trailing slash
-		delimiter = "/",
-		max_results = 1,
-	)
-	next(blobs, None)  # Force blobs to load.
-	print(list(blobs.prefixes))
-
-	print(list_dataloggers())
\ No newline at end of file
+	print(list_dataloggers(snapshot_ttl_s = 60 * 60))
\ No newline at end of file
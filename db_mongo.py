@@ -1,30 +1,162 @@
+import pymongo
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
 import urllib.parse
-import datetime
 from bson.objectid import ObjectId
 import pandas as pd
 import time
+import math
 import certifi
 import decimal
+import threading
 import streamlit as st
 
+import functions
+from audit import AuditLog
+from mongo_monitoring import CommandStats, PoolStats
 
-def updated_fields(old_dict, new_dict, exclude = ('history',)):
-	for ex in exclude:
-		if ex in old_dict:
-			del old_dict[ex]
-		if ex in new_dict:
-			del new_dict[ex]
 
-	# this fails for a list in the dict
+# MongoClient options, any of them can be overridden in a [mongo_client] secrets table
+CLIENT_OPTIONS = {
+	'maxPoolSize': 20,
+	'minPoolSize': 2, # kept open in the background, so the first query skips the TLS handshake
+	'maxIdleTimeMS': 5 * 60 * 1000,
+	'connectTimeoutMS': 10 * 1000,
+	'serverSelectionTimeoutMS': 10 * 1000,
+	'socketTimeoutMS': 60 * 1000,
+	'waitQueueTimeoutMS': 10 * 1000,
+	'compressors': 'zstd,zlib', # first one the server supports is used, zstd needs zstandard installed
+	'readPreference': 'primary',
+}
+
+COLLECTIONS = ('events', 'tools', 'users', 'sessions', 'studies', 'gnss')
+
+# dtypes of the known fields of each collection, other fields are left as pandas infers them
+SCHEMAS = {
+	'tools': {
+		'_id': 'string', 'datalogger': 'string', 'user': 'string',
+		'brand': 'category', 'model': 'string', 'SN': 'string', 'description': 'string',
+		'timezone': 'category', 'hotspot': 'string'
+	},
+	'users': {
+		'_id': 'string', 'name': 'string', 'address': 'string', 'phone': 'string',
+		'email': 'string', 'company': 'category', 'description': 'string'
+	},
+	'events': {
+		'_id': 'string', 'datalogger': 'category', 'filename': 'string',
+		'timestamp': 'Int64', 'duration': 'float64', 'avgCurrent': 'float64', 'energy': 'float64',
+		'date': 'datetime64[ns]', 'migrated_to_bigquery': 'boolean'
+	},
+	# DB_Handler.active_tools, small enough that categories would not pay off
+	'active_tools': {
+		'datalogger': 'string', 'brand': 'string', 'model': 'string', 'SN': 'string', 'description': 'string',
+		'timezone': 'string', 'hotspot': 'string', 'name': 'string', 'Tool Name': 'string'
+	}
+}
+
+ACTIVE_TOOL_COLUMNS = list(SCHEMAS['active_tools'])
+
+# indexes the app's queries depend on, besides _id and the history ones of AuditLog
+# see index_advisor.py for the queries they serve
+INDEXES = {
+	'tools': [
+		[('datalogger', 1)]
+	],
+	'events': [
+		# equality, sort, then range: migrate_mongodb_to_bigquery
+		[('datalogger', 1), ('date', 1), ('_id', 1), ('migrated_to_bigquery', 1)]
+		# SyncDaemon scans a range of _id, served by the _id index
+	]
+	# ReferenceCache.signal reads the newest _id of tools and users from the _id index
+}
+
+
+def ensure_indexes(db):
+	""" create INDEXES on the pymongo database db, idempotent """
+	for collection, indexes in INDEXES.items():
+		for keys in indexes:
+			db[collection].create_index(keys)
+	return
+
+
+def apply_schema(dfi, schema, categories = True):
+	""" cast the columns of dfi named in schema, unparseable values become missing """
+	for column, dtype in schema.items():
+		if column not in dfi.columns:
+			continue
+		if dtype == 'category':
+			if categories:
+				dfi[column] = dfi[column].astype('string').astype('category')
+		elif dtype.startswith('datetime64'):
+			dfi[column] = pd.to_datetime(dfi[column], errors = 'coerce')
+		elif dtype in ('Int64', 'float64'):
+			dfi[column] = pd.to_numeric(dfi[column], errors = 'coerce').astype(dtype)
+		else:
+			dfi[column] = dfi[column].astype(dtype)
+	return dfi
+
+
+def frame_from_cursor(cursor, schema = None, columns = None, batch_size = 1000):
+	"""
+	DataFrame of the documents of a cursor, read batch_size at a time and typed with schema as it goes
+	so the whole result never sits in memory as a list of dicts
+	categories are set once at the end, so every batch shares them
+	columns: columns of the result when the cursor is empty, defaults to the schema's
+	"""
+	schema = schema or dict()
+	if hasattr(cursor, 'batch_size'):
+		cursor = cursor.batch_size(batch_size)
+	frames = [
+		apply_schema(pd.DataFrame(batch), schema, categories = False)
+		for batch in functions.chunks(cursor, batch_size)
+	]
+	if len(frames) <= 0:
+		return apply_schema(pd.DataFrame(columns = columns if columns is not None else list(schema)), schema)
+	dfi = pd.concat(frames, ignore_index = True) if len(frames) > 1 else frames[0]
+	return apply_schema(dfi, {k: v for k, v in schema.items() if v == 'category'})
+
+
+def values_equal(a, b):
+	if isinstance(a, float) and isinstance(b, float) and math.isnan(a) and math.isnan(b):
+		return True
 	try:
-		result = dict(set(new_dict.items()) - set(old_dict.items()))
-	except TypeError as e:
-		print(e)
-		print(old_dict, new_dict)
+		return bool(a == b)
+	except (TypeError, ValueError):
+		return False
+
+
+def diff_value(old, new, path):
+	if isinstance(old, dict) and isinstance(new, dict):
+		if not set(old).issubset(new):
+			return {path: new} # keys were removed, $set replaces the whole dict
+		return updated_fields(old, new, exclude = (), prefix = path + '.')
+	if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
 		result = dict()
+		for i, (o, n) in enumerate(zip(old, new)):
+			result.update(diff_value(o, n, f'{path}.{i}'))
+		return result
+	if values_equal(old, new):
+		return dict()
+	return {path: new}
+
 
+def updated_fields(old_dict, new_dict, exclude = ('history',), prefix = ''):
+	"""
+	deep diff of new_dict against old_dict, neither is modified
+	returns {dotted path: new value} of what changed, ready for $set, e.g. {'schedule.1.User': 'Jo'}
+	nested dicts are compared key by key, or replaced whole if keys were removed,
+	lists of the same length item by item, other lists are replaced whole
+	top level keys missing from new_dict are left as they are, new_dict is a partial update
+	"""
+	result = dict()
+	for k, v in new_dict.items():
+		if k in exclude:
+			continue
+		path = prefix + str(k)
+		if k not in old_dict:
+			result[path] = v
+			continue
+		result.update(diff_value(old_dict[k], v, path))
 	return result
 
 
@@ -37,22 +169,72 @@ def list_dataloggers_from_db(db):
 
 class DB_Handler():
 	def __init__(self, db_name = 'datalogger'):
+		self.command_stats = CommandStats()
+		self.pool_stats = PoolStats()
 		self.client = self.get_client()
 		self.db = self.client[db_name]
 		self.t_last_op = 0
+		self.listeners = list() # called with the collection name after every write
+		self.warm_up_thread = None
+		self.warm_up_time = None
+		self.warm_up_error = None
 
-		self.events = None
-		self.tools = None
-		self.users = None
-		self.sessions = None
-		self.studies = None
-		self.gnss = None
-		# shorten references
-		for col in self.db.list_collection_names():
+		# shorten references, no round trip needed, the rest are added by warm_up
+		for col in COLLECTIONS:
 			setattr(self, col, self.db[col])
 
+		self.audit = AuditLog(
+			self.db,
+			ttl_days = functions.secret('history_ttl_days'),
+			capped_bytes = functions.secret('history_capped_bytes')
+		)
+
 		return
 
+	def start_warm_up(self):
+		""" run warm_up in a background thread, so the app does not wait for it """
+		if self.warm_up_thread is None:
+			self.warm_up_thread = threading.Thread(target = self.warm_up, name = 'db_warm_up', daemon = True)
+			self.warm_up_thread.start()
+		return self.warm_up_thread
+
+	def warm_up(self):
+		""" discover the replica set, open the pool's first connections and create the indexes the app needs """
+		t0 = time.perf_counter()
+		try:
+			self.client.admin.command('ping')
+			for col in self.db.list_collection_names():
+				if not hasattr(self, col):
+					setattr(self, col, self.db[col])
+			self.ensure_indexes()
+		except pymongo.errors.PyMongoError as e:
+			self.warm_up_error = str(e)
+			print('db warm up failed', e)
+			return
+		self.warm_up_time = time.perf_counter() - t0
+		print(f'db warm up {self.warm_up_time:.2f} s')
+		return
+
+	def ensure_indexes(self):
+		ensure_indexes(self.db)
+		self.audit.ensure_indexes()
+		return
+
+	def health(self):
+		""" for the diagnostics page """
+		return {
+			'warm up (s)': self.warm_up_time,
+			'warm up error': self.warm_up_error,
+			'commands': self.command_stats.summary(),
+			'recent errors': [r for r in self.command_stats.recent if r['error']],
+			'pool': self.pool_stats.summary()
+		}
+
+	def client_options(self):
+		options = dict(CLIENT_OPTIONS)
+		options.update(functions.secret('mongo_client', {}))
+		return options
+
 	def get_client(self) -> MongoClient:
 		DB_USERNAME = urllib.parse.quote_plus(st.secrets['mongo_username'])
 		DB_PASSWORD = urllib.parse.quote_plus(st.secrets['mongo_password'])
@@ -87,57 +269,166 @@ class DB_Handler():
 			uri,
 			server_api = ServerApi('1'),
 			tlsCAFile = ca,
-			connect = False
+			connect = False,
+			event_listeners = [self.command_stats, self.pool_stats],
+			**self.client_options()
 		)
 		return client
 
+	def notify(self, collection):
+		for listener in self.listeners:
+			listener(collection)
+		return
+
+	def who(self):
+		if st.session_state.get('authentication_status'):
+			return st.session_state.get("name")
+		return None
+
 	def insert(self, collection, data):
-		data.update({'history': []})
 		for k, v in data.items():
 			if isinstance(v, decimal.Decimal):
 				data[k] = float(v)
 
 		new_doc = self.db[collection].insert_one(data)
+		self.audit.record(collection, new_doc.inserted_id, {k: v for k, v in data.items() if k != '_id'}, self.who())
 		self.t_last_op = time.time()
+		self.notify(collection)
 		return new_doc.inserted_id
 
-	def update(self, collection, _id, data):
+	def prepare_update(self, _id, data):
+		""" returns (ObjectId, data with decimals as float), or (None, None) if _id is unusable """
 		if type(_id) not in [bytes, str, ObjectId]:
 			print('warning type(_id)', type(_id), _id)
 			_id = str(_id)
 		if _id == 'nan':
 			print('warning _id', _id)
-			return
-
-		# old_doc = self.db[collection].find_one({'_id': ObjectId(_id)})
+			return None, None
 
 		if 'history' in data:
 			raise ValueError('Cannot directly update history')
 
-		if len(data) <= 0:
-			return
+		data = {k: float(v) if isinstance(v, decimal.Decimal) else v for k, v in data.items()}
+		return ObjectId(_id), data
 
-		for k, v in data.items():
-			if isinstance(v, decimal.Decimal):
-				data[k] = float(v)
+	def old_values(self, collection, ids, data_list):
+		""" {_id: current document}, with only the top level fields that data_list would set """
+		fields = {k.split('.')[0]: 1 for data in data_list for k in data}
+		return {d['_id']: d for d in self.db[collection].find({'_id': {'$in': list(ids)}}, fields)}
 
-		hist = {
-			'what': data,
-			'when': datetime.datetime.now()
-		}
-		if st.session_state.get('authentication_status'):
-			hist.update({
-				'who': st.session_state.get("name")
-			})
+	def update(self, collection, _id, data):
+		"""
+		$set only the fields that differ from the stored document, nested lists and dicts included
+		unchanged submits write nothing, history records only the changed fields
+		returns the changes {dotted path: new value}
+		"""
+		_id, data = self.prepare_update(_id, data)
+		if _id is None or len(data) <= 0:
+			return dict()
+
+		old_doc = self.old_values(collection, [_id], [data]).get(_id)
+		if old_doc is None:
+			print('warning update of missing document', collection, _id)
+			return dict()
 
-		self.db[collection].update_one({'_id': ObjectId(_id)}, {'$set': data, '$push': {'history': hist}})
+		changes = updated_fields(old_doc, data)
+		if len(changes) <= 0:
+			return changes
+
+		self.db[collection].update_one({'_id': _id}, {'$set': changes})
+		self.audit.record(collection, _id, changes, self.who())
 		self.t_last_op = time.time()
-		return
+		self.notify(collection)
+		return changes
+
+	def bulk_update(self, collection, updates):
+		"""
+		updates: list of (_id, data), each diffed like update
+		all changes go in one bulk_write, their history in one insert_many
+		returns {str(_id): changes} of the documents that changed
+		"""
+		prepared = [self.prepare_update(_id, data) for _id, data in updates]
+		prepared = [(_id, data) for _id, data in prepared if _id is not None and data]
+		old_docs = self.old_values(collection, {_id for _id, data in prepared}, [data for _id, data in prepared])
+
+		requests = list()
+		entries = list()
+		changed = dict()
+		who = self.who()
+		for _id, data in prepared:
+			if _id not in old_docs:
+				print('warning update of missing document', collection, _id)
+				continue
+			changes = updated_fields(old_docs[_id], data)
+			if len(changes) <= 0:
+				continue
+			requests.append(pymongo.UpdateOne({'_id': _id}, {'$set': changes}))
+			entries.append(self.audit.entry(collection, _id, changes, who))
+			changed.setdefault(str(_id), dict()).update(changes)
+
+		if len(requests) <= 0:
+			return changed
+
+		self.db[collection].bulk_write(requests, ordered = True)
+		self.audit.record_many(entries)
+		self.t_last_op = time.time()
+		self.notify(collection)
+		return changed
+
+	def find(self, collection, query = None, projection = None):
+		"""
+		cursor over a collection, the history array is left out unless the projection names it
+		projection: mongodb projection, e.g. {'name': 1} or {'history': {'$slice': -1}}
+		"""
+		projection = dict(projection or {})
+		inclusion = any(v in (1, True) for k, v in projection.items() if k != '_id')
+		if 'history' not in projection and not inclusion:
+			projection['history'] = 0
+		return self.db[collection].find(query or {}, projection)
+
+	def df(self, cursor, query = None, projection = None, schema = None):
+		"""
+		cursor: a pymongo cursor, or a collection name to read with find(collection, query, projection)
+		schema: {column: dtype}, defaults to SCHEMAS of the collection, _id is always a string
+		"""
+		if isinstance(cursor, str):
+			schema = schema or SCHEMAS.get(cursor)
+			cursor = self.find(cursor, query, projection)
+		schema = dict(schema or {})
+		schema.setdefault('_id', 'string')
+		return frame_from_cursor(cursor, schema, columns = [])
+
+	def active_tools(self, datalogger_ids):
+		"""
+		the tools of datalogger_ids joined to their user's name, computed by mongodb
+		only the displayed columns are transferred, ACTIVE_TOOL_COLUMNS, one row per tool
+		"""
+		pipeline = [
+			{'$match': {'datalogger': {'$in': list(datalogger_ids)}}},
+			{'$lookup': {
+				'from': 'users',
+				'let': {'user': '$user'},
+				'pipeline': [
+					{'$match': {'$expr': {'$eq': ['$_id', {'$convert': {'input': '$$user', 'to': 'objectId', 'onError': None, 'onNull': None}}]}}},
+					{'$project': {'_id': 0, 'name': 1}}
+				],
+				'as': 'user_doc'
+			}},
+			{'$project': {
+				'_id': 0,
+				'datalogger': 1, 'brand': 1, 'model': 1, 'SN': 1, 'description': 1, 'timezone': 1, 'hotspot': 1,
+				'name': {'$arrayElemAt': ['$user_doc.name', 0]},
+				'Tool Name': {'$concat': [{'$toString': '$model'}, ' ', {'$toString': '$SN'}]}
+			}}
+		]
+		return frame_from_cursor(self.db.tools.aggregate(pipeline), SCHEMAS['active_tools'])
+
+	def get_history(self, collection, _id, page = 0):
+		""" one page of the history of a single document, newest first """
+		return self.audit.page(collection, _id, page)
 
-	def df(self, cursor):
-		dfi = pd.DataFrame(list(cursor))
-		dfi['_id'] = dfi['_id'].astype(str)
-		return dfi
+	def history_pages(self, collection, _id):
+		return self.audit.pages(collection, _id)
 
 if __name__ == '__main__':
 	# Create a new client and connect to the server
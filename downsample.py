@@ -0,0 +1,129 @@
+"""
+downsampling of event traces for plotting, keeps the shape of every plotted variable
+	minmax: the rows holding each bucket's min and max, so current dips and spikes both survive
+	lttb: largest triangle three buckets, the row per bucket that best keeps the visual shape
+rows are selected for all variables in one pass and merged, so the result is one frame like the input
+"""
+import math
+
+import numpy as np
+import pandas as pd
+
+
+MODES = ('minmax', 'lttb')
+# bucket_width assumes every bucket is full, idle gaps and merged rows leave the budget mostly unused,
+# so the width is refined until this much of max_points is used, aiming at REFINE_TARGET of it
+FILL = 0.8
+REFINE_TARGET = 0.95
+REFINE_PASSES = 6
+
+
+def bucket_width(span, n_rows, n_vars, max_points, mode = 'minmax', min_width = None):
+	"""
+	seconds per bucket that keeps n_vars * rows under max_points, in one step
+	every bucket keeps at most its first and last row plus a min and a max row per variable for minmax,
+	1 row per variable for lttb
+	None if no downsampling is needed
+	"""
+	rows_per_bucket = 2 + 2 * n_vars if mode == 'minmax' else n_vars
+	if n_rows * n_vars <= max_points and not min_width:
+		return None
+	n_buckets = max(1, math.floor(max_points / (n_vars * rows_per_bucket)))
+	width = span / n_buckets if span > 0 else 1.0
+	if min_width:
+		width = max(width, float(min_width))
+	return width
+
+
+def minmax_rows(t, values, width):
+	""" sorted positions of the first, last, min and max rows of every bucket of width seconds, for every column of values """
+	bucket = np.floor((t - t[0]) / width).astype('int64')
+	starts = np.flatnonzero(np.diff(bucket, prepend = bucket[0] - 1))
+	ends = np.append(starts[1:], len(t)) - 1
+	rows = [starts, ends]
+	for column in values.T:
+		# all-NaN buckets fall back to their first row
+		low = np.minimum.reduceat(np.where(np.isnan(column), np.inf, column), starts)
+		high = np.maximum.reduceat(np.where(np.isnan(column), -np.inf, column), starts)
+		is_low = column == np.repeat(low, ends - starts + 1)
+		is_high = column == np.repeat(high, ends - starts + 1)
+		# first row per bucket that holds the extreme
+		rows.append(np.flatnonzero(is_low)[np.unique(bucket[is_low], return_index = True)[1]])
+		rows.append(np.flatnonzero(is_high)[np.unique(bucket[is_high], return_index = True)[1]])
+	return np.unique(np.concatenate(rows))
+
+
+def lttb_rows(t, y, n_out):
+	""" positions of the n_out rows largest triangle three buckets keeps of the series (t, y) """
+	n = len(t)
+	if n_out >= n or n_out < 3:
+		return np.arange(n)
+	y = np.where(np.isnan(y), np.nanmean(y) if np.isfinite(y).any() else 0.0, y)
+	edges = np.linspace(1, n - 1, n_out - 1).astype('int64')
+	selected = np.empty(n_out, dtype = 'int64')
+	selected[0] = 0
+	selected[-1] = n - 1
+	a = 0
+	for i in range(n_out - 2):
+		lo, hi = edges[i], edges[i + 1]
+		next_hi = edges[i + 2] if i + 2 < len(edges) else n
+		# the next bucket's average is the third corner of the triangle
+		t_next = t[hi:next_hi].mean()
+		y_next = y[hi:next_hi].mean()
+		area = np.abs((t[a] - t_next) * (y[lo:hi] - y[a]) - (t[a] - t[lo:hi]) * (y_next - y[a]))
+		a = lo + int(np.argmax(area))
+		selected[i + 1] = a
+	return selected
+
+
+def downsample(df, x, ys, max_points = 100_000, mode = 'minmax', min_width = None):
+	"""
+	rows of df to plot ys against x with at most about max_points points in total
+	x: numeric column, sorted, e.g. 't (s)'
+	min_width: smallest bucket in seconds, e.g. a resample rate the user picked
+	the bucket width starts from the worst case of bucket_width and is refined while the budget is mostly unused
+	returns (DataFrame, bucket width in seconds or None if df was returned whole)
+	"""
+	if mode not in MODES:
+		raise ValueError(f'downsample mode not supported: {mode}')
+	ys = [y for y in ys if y in df.columns and pd.api.types.is_numeric_dtype(df[y])]
+	if df.empty or not ys:
+		return df, None
+
+	if not df[x].is_monotonic_increasing:
+		df = df.sort_values(x)
+	t = df[x].to_numpy(dtype = 'float64')
+	t = t - t[0]
+	span = float(t[-1] - t[0])
+	width = bucket_width(span, len(t), len(ys), max_points, mode, min_width)
+	if width is None:
+		return df, None
+
+	values = df[ys].to_numpy(dtype = 'float64')
+	rows = select_rows(t, values, width, mode)
+	candidate = width
+	for _ in range(REFINE_PASSES):
+		points = len(rows) * len(ys)
+		if points >= FILL * max_points:
+			break
+		if candidate >= width:
+			# points grow about as 1 / width
+			candidate = width * points / (REFINE_TARGET * max_points)
+		if min_width:
+			candidate = max(candidate, float(min_width))
+		if candidate >= width:
+			break
+		finer = select_rows(t, values, candidate, mode)
+		if len(finer) * len(ys) <= max_points:
+			rows, width = finer, candidate
+		else:
+			candidate = (width + candidate) / 2
+	return df.iloc[rows], width
+
+
+def select_rows(t, values, width, mode):
+	""" sorted positions of the rows kept with buckets of width seconds """
+	if mode == 'minmax':
+		return minmax_rows(t, values, width)
+	n_out = max(3, math.ceil(float(t[-1] - t[0]) / width))
+	return np.unique(np.concatenate([lttb_rows(t, column, n_out) for column in values.T]))
@@ -1,5 +1,6 @@
 import os
 import streamlit as st
+from memoization import cached
 
 import pandas as pd
 import numpy as np
@@ -47,14 +48,15 @@ def events_df_by_id_and_date_range(
 			('date', '<=', end_date)
 		],
 		order = [('timestamp', 'asc')],
-		table = 'events'
+		table = 'events',
+		site = 'events_by_id_and_date_range'
 	)
 
 	return rows.to_dataframe()
 
 
-@st.cache_data
-def events_df_recent(limit = 100, start_date = None, end_date = None, select = None):
+def events_recent_query(limit = 100, start_date = None, end_date = None, select = None):
+	""" (sql, params) of the latest events of all dataloggers, for bigquery.guarded_query """
 	if select is None:
 		select = ['*']
 
@@ -63,7 +65,7 @@ def events_df_recent(limit = 100, start_date = None, end_date = None, select = N
 		where.append(('date', '>=', start_date))
 	if end_date:
 		where.append(('date', '<=', end_date))
-	rows = bigquery.find(
+	return bigquery.build_find(
 		select,
 		where = where,
 		order = [('timestamp', 'desc')],
@@ -71,76 +73,128 @@ def events_df_recent(limit = 100, start_date = None, end_date = None, select = N
 		limit = limit
 	)
 
-	return rows.to_dataframe()
+
+def events_df_recent(limit = 100, start_date = None, end_date = None, select = None):
+	""" without the scan guard of the events page, cached by bigquery.df_from_query """
+	statement, params = events_recent_query(limit, start_date, end_date, select)
+	return bigquery.df_from_query(statement, tuple(params), 'events_recent')
+
+
+def is_charging(df):
+	""" events with a negative average current, charging the battery """
+	return (df['avgCurrent'] < 0).fillna(False).astype(bool)
+
+
+def label_sessions(df, timeout_s = 60):
+	"""
+	input a dataframe of events sorted by timestamp
+	returns a copy with integer columns added, no slicing:
+		session_id: events adjacent in time by less than timeout_s share a session
+		charging: avgCurrent < 0
+		segment_id: consecutive events in the same session and charging state share a segment
+	"""
+	end_timestamp = df['timestamp'] + pd.to_numeric(df['duration'])
+	time_to_next = pd.to_numeric(df['timestamp'].shift(-1) - end_timestamp).astype('float64').fillna(60 * 60 * 24)
+	new_session = (time_to_next > timeout_s).shift(1, fill_value = True)
+	charging = is_charging(df)
+	new_segment = new_session | (charging != charging.shift(1, fill_value = False))
+	return df.assign(
+		end_timestamp = end_timestamp,
+		time_to_next = time_to_next,
+		charging = charging,
+		session_id = new_session.cumsum().astype('int64') - 1,
+		segment_id = new_segment.cumsum().astype('int64') - 1
+	)
 
 
 def combine_adjacent_events(df, timeout_s = 60):
 	""" input a dataframe of events
 	returns a list of dataframes,
-	events grouped together that are adjacent in time by less than the timeout_s """
+	events grouped together that are adjacent in time by less than the timeout_s
+	every event is in a session, the first one included """
 	if len(df.index) <= 1:
 		return [df]
-	df['end_timestamp'] = df['timestamp'] + df['duration']
-	df['time_to_next'] = df['timestamp'].shift(-1) - df['end_timestamp']
-	df['time_to_next'] = pd.to_numeric(df['time_to_next'])
-	df['time_to_next'] = df['time_to_next'].fillna(60 * 60 * 24)
-
-	# find indexes to split sessions
-	# based on exceeding the session_timeout
-	idx = np.append([0], np.where(df['time_to_next'] > timeout_s))
-
-	# split df to list of dfs based on session indexes
-	# https://stackoverflow.com/a/53395439/2666454
-	dfs_by_session = [df.iloc[idx[n] + 1:idx[n + 1] + 1] for n in range(len(idx) - 1)]
-
-	return dfs_by_session
+	df = label_sessions(df, timeout_s)
+	return [dfi for session_id, dfi in df.groupby('session_id', sort = True)]
 
 
 def split_events_by_charging(dfs):
-	dfs_r = list()
-	for dfi in dfs:
-		dfi['charging'] = (dfi['avgCurrent'] < 0)
-		dfg = dfi.groupby('charging')
-		for name, data in dfg:
-			dfs_r.append(data)
-	return dfs_r
+	"""
+	split each dataframe of a session into discharging then charging dataframes
+	the same groups as summarize_events, (session, charging) with the charging of label_sessions
+	"""
+	dfs = [dfi for dfi in dfs if not dfi.empty]
+	if len(dfs) == 0:
+		return list()
+	df = pd.concat(dfs, keys = range(len(dfs)), names = ['session', None]).reset_index(level = 'session')
+	df['charging'] = is_charging(df)
+	return [dfi.drop(columns = 'session') for _, dfi in df.groupby(['session', 'charging'], sort = True)]
+
+
+def summarize_groups(df, by, timezone):
+	""" one summary row per group of events, in sorted order of the by column(s) """
+	df = df.assign(
+		duration = pd.to_numeric(df['duration']),
+		energy = pd.to_numeric(df['energy'])
+	)
+	df['end'] = df['timestamp'].astype('float64') + df['duration']
+	summary = df.groupby(by, sort = True).agg(
+		timestamp = ('timestamp', 'min'),
+		end = ('end', 'max'),
+		duration = ('duration', 'sum'),
+		energy = ('energy', 'sum'),
+		date = ('date', 'first'),
+		filenames = ('filename', list)
+	).reset_index(drop = True)
+
+	local_time = pd.to_datetime(summary['timestamp'].astype('float64'), unit = 's', utc = True)
+	return pd.DataFrame({
+		'Time (local)': local_time.dt.tz_convert(timezone),
+		'Timezone': timezone,
+		'timestamp': summary['timestamp'],
+		'End timestamp': summary['end'].astype('float64'),
+		'Duration': functions.seconds_to_string_series(summary['duration']),
+		'Duration (s)': summary['duration'].astype('float64'),
+		'Energy (Wh)': summary['energy'].astype('float64'),
+		'date': summary['date'],
+		'filenames': summary['filenames']
+	})
 
 
 def events_list_summarized(dfs, timezone):
 	""" input list of dataframes, each dataframe a list of events
 	returns one dataframe, with a row for each item from the list summarized """
-	df = pd.DataFrame()
-	for dfi in dfs:
-		if dfi.empty:
-			continue
-		duration_sum = dfi['duration'].sum()
-		start_timestamp = dfi['timestamp'].min()
-		row = pd.DataFrame([{
-			'Time (local)': functions.timestamp_to_local_time(start_timestamp, timezone),
-			'Timezone': timezone,
-			'timestamp': start_timestamp,
-			'Duration': functions.seconds_to_string(duration_sum),
-			'Duration (s)': duration_sum,
-			'Energy (Wh)': dfi['energy'].sum(),
-			'date': dfi['date'].iloc[0],
-			'filenames': dfi['filename'].tolist()
-		}])
-		df = pd.concat([df, row], ignore_index = True)
-
-	df['Duration (s)'] = df['Duration (s)'].astype('float64')
-	df['Energy (Wh)'] = df['Energy (Wh)'].astype('float64')
+	dfs = [dfi for dfi in dfs if not dfi.empty]
+	if len(dfs) == 0:
+		return summarize_groups(pd.DataFrame(columns = ['group', 'timestamp', 'duration', 'energy', 'date', 'filename']), 'group', timezone)
+	df = pd.concat(dfs, keys = range(len(dfs)), names = ['group', None]).reset_index(level = 'group')
+	return summarize_groups(df, 'group', timezone)
 
-	return df
 
-def combine_events(df, timeout_s = 60):
+def summarize_events(df, timezone, timeout_s = 60):
+	"""
+	:param df: from events_df_by_id_and_date_range, sorted by timestamp
+	:return: one row per session and charging state,
+		a session is events less than timeout_s apart, split into discharging then charging rows
+	"""
+	df = label_sessions(df, timeout_s)
+	return summarize_groups(df, ['session_id', 'charging'], timezone)
+
+
+@st.cache_data(ttl = 5*60, show_spinner = False)
+def summarized_events_by_id_and_date(datalogger_id, date, timezone, timeout_s = 60):
+	""" summarize_events of a datalogger's events on one day, cached per (datalogger, date, timezone, timeout_s) """
+	events = events_df_by_id_and_date_range(datalogger_id, start_date = date, end_date = date)
+	return summarize_events(events, timezone, timeout_s)
+
+
+def combine_events(df, timeout_s = 60, timezone = 'UTC'):
 	"""
 	:param df: from events_df_by_id_and_date_range
-	:return:
+	:return: summary of sessions, see summarize_events
 	"""
-	dfs_by_session = combine_adjacent_events(df, timeout_s)
-	dfs_by_session_and_charging = split_events_by_charging(dfs_by_session)
-	df_r = events_list_summarized(dfs_by_session_and_charging)
-	return df_r
+	return summarize_events(df, timezone, timeout_s)
+
 
 def event_by_filename(cloud_filename, timezone):
 	rows = bigquery.find(
@@ -194,6 +248,138 @@ def fix_energy_values(df):
 
 	return df
 
+
+# columns that may be stored as float32, with the error allowed, well under the sensor resolution
+# (INA228: 195 uV bus voltage, 7.8 m deg C die temperature)
+# other columns stay float64, t (s) and the cumulative energy would drift over long events
+DOWNCAST_ATOL = {
+	'voltage (V)': 1e-4,
+	'current (A)': 1e-4,
+	'power (W)': 1e-3,
+	'temperature (deg C)': 1e-3,
+	'dt (s)': 5e-7, # half a microsecond, V5 dt (us) is an integer
+}
+
+
+def downcast_floats(df, atol = None):
+	"""
+	store float64 columns as float32 where every value round trips within the column's absolute tolerance
+	atol: {column: tolerance}, defaults to DOWNCAST_ATOL, columns not in it are left as they are
+	"""
+	atol = DOWNCAST_ATOL if atol is None else atol
+	for col, tolerance in atol.items():
+		if col not in df.columns or df[col].dtype != 'float64':
+			continue
+		down = df[col].astype('float32')
+		if np.allclose(down.to_numpy('float64'), df[col].to_numpy(), rtol = 0, atol = tolerance, equal_nan = True):
+			df[col] = down
+	return df
+
+
+# bump when harmonize_columns, fix_energy_values or downcast_floats change what is cached,
+# parquet copies of another version are converted again
+EVENT_FRAME_VERSION = 2
+
+
+def event_parquet_filename(local_filename):
+	return local_filename + '.parquet'
+
+
+def convert_event_csv(local_filename):
+	""" harmonize and type a downloaded event csv, saved as parquet next to it """
+	df = pd.read_csv(local_filename)
+	df = harmonize_columns(df)
+	if df is None:
+		raise ValueError('unrecognized columns in ' + local_filename)
+	df = downcast_floats(df)
+	df.attrs['event_frame_version'] = EVENT_FRAME_VERSION # kept in the parquet metadata
+	functions.save_parquet(event_parquet_filename(local_filename), df)
+	return df
+
+
+def read_event_frame(local_filename):
+	"""
+	harmonized df of a downloaded event csv, from the parquet copy when it is newer than the csv and of this version
+	the copy is made here on first read rather than in data_from_cloud.download_blob,
+	which downloads every kind of blob and would convert files that are never read
+	"""
+	parquet_filename = event_parquet_filename(local_filename)
+	try:
+		if os.path.getmtime(parquet_filename) >= os.path.getmtime(local_filename):
+			df = pd.read_parquet(parquet_filename)
+			if df.attrs.get('event_frame_version') == EVENT_FRAME_VERSION:
+				return df
+	except OSError:
+		pass
+	return convert_event_csv(local_filename)
+
+
+def clean_event_frame(local_filename):
+	""" harmonized df of a downloaded event file with corrected energy, t (s) from the start of the event """
+	df = read_event_frame(local_filename)
+	df = fix_energy_values(df)
+	df = functions.remove_outliers(df, ['current (A)'], 6) # remove extreme outliers
+	return df
+
+
+def add_time(df, local_filename, timezone):
+	""" make t (s) unix time and add the local time column """
+	df['t (s)'] = df['t (s)'] + timestamp_from_filename(local_filename)
+	df['time'] = pd.to_datetime(df['t (s)'], unit = 's', utc = True)
+	df['time'] = df['time'].dt.tz_convert(timezone)
+	return df
+
+
+def parse_event_file(local_filename, timezone):
+	""" read a downloaded event file into a harmonized df with local time and corrected energy """
+	df = add_time(read_event_frame(local_filename), local_filename, timezone)
+	df = fix_energy_values(df)
+	df = functions.remove_outliers(df, ['current (A)'], 6) # remove extreme outliers
+	return df
+
+
+def load_event_files(server_filenames, timezone, max_workers = 8):
+	"""
+	download and parse many event files
+	downloads run in a bounded thread pool, each file is parsed as soon as its download finishes
+	returns (dfs, errors)
+		dfs in the same order as server_filenames, failed files left out
+		errors is a list of (server_filename, exception), also in the original order
+	"""
+	dfs = [None] * len(server_filenames)
+	errors = dict()
+	downloads = data_from_cloud.download_blobs_by_name(server_filenames, max_workers = max_workers)
+	for i, server_filename, local_filename, error in downloads:
+		if error is None:
+			try:
+				dfs[i] = parse_event_file(local_filename, timezone)
+			except (pd.errors.EmptyDataError, ValueError, KeyError) as e:
+				error = e
+		if error is not None:
+			print(server_filename, 'error', error)
+			errors[i] = (server_filename, error)
+
+	dfs = [df for df in dfs if df is not None]
+	errors = [errors[i] for i in sorted(errors)]
+	return dfs, errors
+
+
+@cached(max_size = 4, ttl = 15*60)
+def load_selected_events(server_filenames, timezone):
+	"""
+	one df of the event files server_filenames, a tuple, with energy accumulated across them
+	returns (df or None if no file loaded, errors like load_event_files)
+	kept in memory for the last few selections so a rerun with the same files does not reload them,
+	the df is shared between reruns and must not be modified in place
+	"""
+	dfs, errors = load_event_files(list(server_filenames), timezone)
+	if len(dfs) == 0:
+		return None, errors
+	df = pd.concat(dfs)
+	df = fix_energy_values(df)
+	return df, errors
+
+
 class Event:
 	def __init__(self, row, timezone):
 		"""
@@ -229,8 +415,7 @@ class Event:
 
 	def post_process(self):
 		if self.df is not None: return
-		self.df = pd.read_csv(self.local_filename)
-		self.harmonize_columns()
+		self.df = read_event_frame(self.local_filename)
 		self.add_local_time()
 		return
 
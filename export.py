@@ -0,0 +1,72 @@
+"""
+export of event frames to files, written in chunks to a temporary directory only when asked for
+"""
+import os
+import gzip
+import time
+import tempfile
+
+import functions
+
+
+# format: (file extension, mime type)
+FORMATS = {
+	'csv.gz': ('.csv.gz', 'application/gzip'),
+	'parquet': ('.parquet', 'application/vnd.apache.parquet'),
+	'csv': ('.csv', 'text/csv')
+}
+
+EXPORT_DIRECTORY = os.path.join(tempfile.gettempdir(), 'data_app_exports')
+MAX_AGE_S = 60 * 60
+
+
+def remove_old_exports(max_age_s = MAX_AGE_S):
+	if not os.path.isdir(EXPORT_DIRECTORY):
+		return
+	for name in os.listdir(EXPORT_DIRECTORY):
+		filename = os.path.join(EXPORT_DIRECTORY, name)
+		try:
+			if time.time() - os.path.getmtime(filename) > max_age_s:
+				os.remove(filename)
+		except OSError:
+			pass
+	return
+
+
+def write_csv(df, f, chunk_rows = 100_000):
+	""" csv text of df to the open file f, chunk_rows rows at a time so the whole text is never in memory """
+	for start in range(0, max(len(df.index), 1), chunk_rows):
+		df.iloc[start:start + chunk_rows].to_csv(f, header = start == 0, index = False)
+	return
+
+
+def write(df, export_format = 'csv.gz', chunk_rows = 100_000):
+	""" write df to a new file in EXPORT_DIRECTORY, returns its filename """
+	extension, mime = FORMATS[export_format]
+	os.makedirs(EXPORT_DIRECTORY, exist_ok = True)
+	remove_old_exports()
+	fd, filename = tempfile.mkstemp(dir = EXPORT_DIRECTORY, suffix = extension)
+	os.close(fd)
+	try:
+		if export_format == 'parquet':
+			functions.save_parquet(filename, df)
+		elif export_format == 'csv.gz':
+			with gzip.open(filename, 'wt', encoding = 'utf-8', newline = '', compresslevel = 6) as f:
+				write_csv(df, f, chunk_rows)
+		else:
+			with open(filename, 'w', encoding = 'utf-8', newline = '') as f:
+				write_csv(df, f, chunk_rows)
+	except BaseException:
+		os.remove(filename)
+		raise
+	return filename
+
+
+def page(df, page_number, page_size = 1000):
+	""" rows of page page_number, counted from 0, for a preview """
+	start = page_number * page_size
+	return df.iloc[start:start + page_size]
+
+
+def n_pages(df, page_size = 1000):
+	return max(1, -(-len(df.index) // page_size))
@@ -1,54 +1,133 @@
-from concurrent.futures import ThreadPoolExecutor
+"""
+recompute event energy from the raw files and correct it in bigquery
+dry run, writes a diff report: python fix_database_values.py
+apply the report with one MERGE: python fix_database_values.py --apply
+rows still in the streaming buffer are left out of the MERGE, a later --apply corrects them
+"""
+import sys
+import datetime
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pandas as pd
 
 import bigquery
 import event
 import data_from_cloud
+import functions
 
 
-statement = (f"SELECT * FROM `i-azimuth-215919.dataloggers.events` "
-             f"WHERE `avgCurrent` < 0 "
-             f"ORDER BY `timestamp` DESC")
-events = bigquery.df_from_query(statement)
+STAGING_TABLE = 'events_energy_fix'
+PROGRESS_FILENAME = 'fix_energy_progress.json'
+REPORT_FILENAME = 'fix_energy_report.csv'
+# rows streamed more recently than this may still be in the streaming buffer, where DML fails
+STREAMING_BUFFER_MINUTES = 90
 
-print(len(events.index), "# events")
 
-worker = ThreadPoolExecutor(1)
-n_fixed = 0
-futures = list()
+def find_candidates():
+    statement = (f"SELECT `filename`, `energy`, `date` FROM `{bigquery.table_name()}` "
+                 f"WHERE `avgCurrent` < 0 "
+                 f"ORDER BY `timestamp` DESC")
+    return bigquery.query(statement, site = 'fix_energy').to_dataframe()
 
-for i, row in enumerate(events.itertuples()):
-    print(i, 'of', len(events.index))
-    local_filename = data_from_cloud.download_blob_by_name(row.filename)
-    try:
-        df = pd.read_csv(local_filename)
-    except (pd.errors.EmptyDataError, ValueError) as e:
-        print(local_filename, 'error', e)
-        continue
-    df = event.harmonize_columns(df)
+
+def recompute_energy(local_filename):
+    """ energy (Wh) of a downloaded event file after fix_energy_values, runs in a worker process """
+    df = event.read_event_frame(local_filename)
     df = event.fix_energy_values(df)
+    return round(float(df['energy (Wh)'].iloc[-1]), 2)
+
+
+def recompute(filenames, progress, max_workers = None, chunk_size = 200):
+    """
+    recompute energy for filenames not already in progress
+    downloads run in the blob thread pool, the recompute in a process pool
+    workers are spawned, not forked, since the download threads are already running
+    progress: {filename: fixed energy, or None if the file could not be read}, saved after every chunk
+    """
+    todo = [f for f in filenames if f not in progress]
+    print(len(todo), 'events to recompute,', len(progress), 'already done')
+
+    with ProcessPoolExecutor(max_workers = max_workers, mp_context = multiprocessing.get_context('spawn')) as pool:
+        for chunk in functions.chunks(todo, chunk_size):
+            futures = dict()
+            for i, filename, local_filename, error in data_from_cloud.download_blobs_by_name(chunk):
+                if error is not None:
+                    print(filename, 'error', error)
+                    progress[filename] = None
+                    continue
+                futures[pool.submit(recompute_energy, local_filename)] = filename
+
+            for future in as_completed(futures):
+                filename = futures[future]
+                try:
+                    progress[filename] = future.result()
+                except (pd.errors.EmptyDataError, ValueError, KeyError, IndexError) as e:
+                    print(filename, 'error', e)
+                    progress[filename] = None
+
+            functions.save_json(PROGRESS_FILENAME, progress)
+            print(len(progress), 'of', len(filenames))
+    return progress
+
+
+def diff_report(candidates, progress):
+    """ events whose recomputed energy differs from bigquery, columns filename, date, old_energy, fixed_energy """
+    report = pd.DataFrame({
+        'filename': candidates['filename'],
+        'date': candidates['date'],
+        'old_energy': pd.to_numeric(candidates['energy']).astype('float64').round(2),
+        'fixed_energy': candidates['filename'].map(progress).astype('float64')
+    })
+    changed = report['fixed_energy'].notna() & (report['fixed_energy'] != report['old_energy'])
+    return report[changed].drop_duplicates('filename').reset_index(drop = True)
+
+
+def apply_corrections(changes):
+    """
+    load (filename, energy) to a staging table, then update events with a single MERGE
+    rows inserted in the last STREAMING_BUFFER_MINUTES are skipped, one in the streaming buffer would abort the whole MERGE
+    returns the number of corrections left for a later run
+    """
+    staging = changes.rename(columns = {'fixed_energy': 'energy'})[['filename', 'energy']]
+    staging_id = bigquery.load_dataframe(staging, STAGING_TABLE, schema = [('filename', 'STRING'), ('energy', 'FLOAT64')])
+    settled = f"COALESCE(T.`timestamp_inserted`, TIMESTAMP '1970-01-01') < TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {STREAMING_BUFFER_MINUTES} MINUTE)"
+
+    statement = (f"MERGE `{bigquery.table_name()}` T "
+                 f"USING `{staging_id}` S "
+                 f"ON T.`filename` = S.`filename` "
+                 f"WHEN MATCHED AND {settled} THEN UPDATE SET `energy` = CAST(S.`energy` AS NUMERIC)")
+    bigquery.query(statement, site = 'fix_energy')
+
+    statement = (f"SELECT COUNT(*) AS `n` FROM `{bigquery.table_name()}` T "
+                 f"JOIN `{staging_id}` S ON T.`filename` = S.`filename` "
+                 f"WHERE T.`energy` != CAST(S.`energy` AS NUMERIC)")
+    return list(bigquery.query(statement, site = 'fix_energy'))[0]['n']
+
+
+if __name__ == '__main__':
+    apply = '--apply' in sys.argv
+
+    candidates = find_candidates()
+    print(len(candidates.index), "# events")
+
+    progress = functions.load_json(PROGRESS_FILENAME, default = dict())
+    progress = recompute(candidates['filename'].tolist(), progress)
+
+    changes = diff_report(candidates, progress)
+    changes.to_csv(REPORT_FILENAME, index = False)
+    print(len(changes.index), 'n_fixed, report in', REPORT_FILENAME)
+    for row in changes.head(20).itertuples():
+        print(f'Energy fixed from {row.old_energy} to {row.fixed_energy} in {row.filename}')
 
-    try:
-        old_energy = round(float(events.iloc[row.Index]['energy']), 2)
-    except KeyError as e:
-        print(row.filename, e)
-        continue
-
-    fixed_energy = round(float(df['energy (Wh)'].iloc[-1]), 2)
-    if fixed_energy != old_energy:
-        print(f'Energy fixed from {old_energy} to {fixed_energy} in {row.filename}')
-
-        # https://stackoverflow.com/a/76113054/2666454
-        future = worker.submit(
-            bigquery.update,
-            'events',
-            f"SET `energy` = {fixed_energy} WHERE `filename` = '{row.filename}' "
-        )
-        print(future.result())
-        futures.append(future)
-        n_fixed = n_fixed + 1
-
-print(n_fixed, 'n_fixed')
-worker.shutdown(wait = False, cancel_futures = False)
-for future in futures:
-    print(future.result())
\ No newline at end of file
+    if not apply:
+        print('dry run, rerun with --apply to update bigquery')
+    elif not changes.empty:
+        pending = apply_corrections(changes)
+        print('applied', len(changes.index) - pending, 'corrections')
+        if pending > 0:
+            print(pending, f'rows are still in the streaming buffer, rerun with --apply in {STREAMING_BUFFER_MINUTES} minutes')
+        # the daily rollup sums the old energies, rebuild the days touched, today is never rolled up
+        dates = pd.to_datetime(changes['date']).dt.date
+        yesterday = datetime.date.today() - datetime.timedelta(days = 1)
+        if dates.min() <= yesterday:
+            bigquery.update_rollup(dates.min(), min(dates.max(), yesterday))
@@ -1,8 +1,13 @@
 import os
+import json
+import itertools
+import tempfile
 import datetime
 from zoneinfo import ZoneInfo
 from scipy import stats
 import numpy as np
+import pandas as pd
+import streamlit as st
 
 def split_path(path):
     """
@@ -14,6 +19,74 @@ def split_path(path):
 
     return dir, base, ext
 
+def secret(name, default = None):
+    """ st.secrets.get, or default when there is no secrets file, e.g. offline benchmarks """
+    try:
+        return st.secrets.get(name, default)
+    except FileNotFoundError:
+        return default
+
+
+def load_json(filename, default = None):
+    """ read a json file, returns default if it is missing or unreadable """
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return default
+
+
+def save_json(filename, data):
+    """ write a json file atomically (temp file then rename) so readers never see a partial file """
+    directory = os.path.dirname(filename) or '.'
+    os.makedirs(directory, exist_ok = True)
+    fd, tmp_filename = tempfile.mkstemp(dir = directory, prefix = '.' + os.path.basename(filename), suffix = '.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, default = str)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+    return filename
+
+
+def save_parquet(filename, df):
+    """ write a parquet file atomically, like save_json """
+    directory = os.path.dirname(filename) or '.'
+    fd, tmp_filename = tempfile.mkstemp(dir = directory, prefix = '.' + os.path.basename(filename), suffix = '.tmp')
+    os.close(fd)
+    try:
+        df.to_parquet(tmp_filename, index = False)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+    return filename
+
+
+def chunks(iterable, size):
+    """ yield lists of up to size items, reading the iterable lazily """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def event_doc_to_row(doc):
+    """ mongodb events document to a bigquery events row """
+    row = {k: v for k, v in doc.items() if k != '_id'}
+    if 'timestamp' in row:
+        row['timestamp'] = int(row['timestamp'])
+    row['time'] = doc['date'].strftime("%H:%M:%S")
+    row['date'] = doc['date'].strftime("%Y-%m-%d")
+    return row
+
+
 def seconds_to_string(seconds):
     if seconds < 60:
         return str(int(seconds)) + 's'
@@ -24,6 +97,27 @@ def seconds_to_string(seconds):
     return str(int(hours)) + 'h ' + str(int(minutes)) + 'm ' + str(int(seconds)) + 's'
 
 
+def seconds_to_string_series(seconds):
+    """ seconds_to_string for a whole pandas Series at once """
+    seconds = seconds.astype('float64').fillna(0)
+    hours = seconds // 3600
+    minutes = (seconds % 3600) // 60
+    secs = seconds % 60
+    s = secs.astype('int64').astype(str) + 's'
+    m = minutes.astype('int64').astype(str) + 'm '
+    h = hours.astype('int64').astype(str) + 'h '
+    text = np.where(seconds < 60, s, np.where(seconds < 60 * 60, m + s, h + m + s))
+    return pd.Series(text, index = seconds.index)
+
+
+def bytes_to_string(n_bytes):
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if abs(n_bytes) < 1024 or unit == 'TB':
+            break
+        n_bytes = n_bytes / 1024
+    return f'{n_bytes:.1f} {unit}'
+
+
 def timestamp_to_local_time(timestamp, timezone):
     try:
         utc_time = datetime.datetime.fromtimestamp(timestamp, tz = ZoneInfo('UTC'))
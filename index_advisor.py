@@ -0,0 +1,118 @@
+"""
+flags the query shapes the app runs that mongodb would answer with a collection scan
+	python index_advisor.py --uri mongodb://localhost:27017 --db datalogger --create
+"""
+import sys
+import argparse
+
+from bson.objectid import ObjectId
+import pymongo
+
+import db_mongo
+from audit import AuditLog
+
+
+DATALOGGER_ID = '00-00-00-00-00-00'
+
+# (name, collection, find filter or aggregation pipeline, sort), values are placeholders, only the shape matters
+QUERY_SHAPES = [
+	('DB_Handler.active_tools $match', 'tools', [{'$match': {'datalogger': {'$in': [DATALOGGER_ID]}}}], None),
+	('tools page user lookup', 'users', {'_id': ObjectId()}, None),
+	('DB_Handler.update old values', 'tools', {'_id': {'$in': [ObjectId()]}}, None),
+	(
+		'migrate_mongodb_to_bigquery',
+		'events',
+		{'datalogger': DATALOGGER_ID, 'migrated_to_bigquery': {'$ne': True}},
+		[('date', 1), ('_id', 1)]
+	),
+	(
+		'migrate_mongodb_to_bigquery below the sync_daemon watermark',
+		'events',
+		{'datalogger': DATALOGGER_ID, 'migrated_to_bigquery': {'$ne': True}, '_id': {'$lte': ObjectId()}},
+		[('date', 1), ('_id', 1)]
+	),
+	(
+		'SyncDaemon.query batch',
+		'events',
+		{'_id': {'$gt': ObjectId(), '$lt': ObjectId()}, 'migrated_to_bigquery': {'$ne': True}},
+		[('_id', 1)]
+	),
+	('SyncDaemon.initial_watermark', 'events', {'migrated_to_bigquery': {'$ne': True}}, [('_id', 1)]),
+	('ReferenceCache.signal tools', 'tools', {}, [('_id', -1)]),
+	('ReferenceCache.signal users', 'users', {}, [('_id', -1)]),
+	('ReferenceCache.signal history', 'history', {'collection': 'tools'}, [('_id', -1)]),
+	('AuditLog.migrate_embedded tools', 'tools', {'history.0': {'$exists': True}}, None),
+	('AuditLog.migrate_embedded users', 'users', {'history.0': {'$exists': True}}, None),
+	('AuditLog.page', 'history', {'collection': 'tools', 'doc_id': ObjectId()}, [('when', -1)]),
+	(
+		'AuditLog.last_updated',
+		'history',
+		[
+			{'$match': {'collection': 'tools'}},
+			{'$sort': {'collection': 1, 'doc_id': 1, 'when': -1}},
+			{'$group': {'_id': '$doc_id', 'when': {'$first': '$when'}}}
+		],
+		None
+	),
+]
+
+# one-off migrations over the whole collection, a scan is expected and not worth an index
+COLLSCAN_OK = ('AuditLog.migrate_embedded tools', 'AuditLog.migrate_embedded users')
+
+
+def stages(plan):
+	""" every stage name in an explain output, nested plans included """
+	if isinstance(plan, dict):
+		if 'stage' in plan:
+			yield plan['stage']
+		for v in plan.values():
+			yield from stages(v)
+	elif isinstance(plan, list):
+		for v in plan:
+			yield from stages(v)
+
+
+def explain(db, collection, query, sort = None):
+	if isinstance(query, list):
+		command = {'aggregate': collection, 'pipeline': query, 'cursor': {}}
+	else:
+		command = {'find': collection, 'filter': query}
+		if sort:
+			command['sort'] = dict(sort)
+	return db.command('explain', command, verbosity = 'queryPlanner')
+
+
+def check(db, shapes = QUERY_SHAPES):
+	""" returns [{query, collection, stages, collscan, expected}], expected: a scan that is fine, see COLLSCAN_OK """
+	results = list()
+	for name, collection, query, sort in shapes:
+		plan_stages = sorted(set(stages(explain(db, collection, query, sort).get('queryPlanner', {}))))
+		results.append({
+			'query': name,
+			'collection': collection,
+			'stages': plan_stages,
+			'collscan': 'COLLSCAN' in plan_stages,
+			'expected': name in COLLSCAN_OK
+		})
+	return results
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = __doc__.strip().splitlines()[0])
+	parser.add_argument('--uri', default = 'mongodb://localhost:27017')
+	parser.add_argument('--db', default = 'datalogger')
+	parser.add_argument('--create', action = 'store_true', help = 'create the declared indexes first')
+	args = parser.parse_args()
+
+	database = pymongo.MongoClient(args.uri)[args.db]
+	if args.create:
+		db_mongo.ensure_indexes(database)
+		AuditLog(database).ensure_indexes()
+
+	results = check(database)
+	for r in results:
+		flag = 'ok      '
+		if r['collscan']:
+			flag = 'one-off ' if r['expected'] else 'COLLSCAN'
+		print(flag, f"{r['collection']:8s}", r['query'], ', '.join(r['stages']))
+	sys.exit(1 if any(r['collscan'] and not r['expected'] for r in results) else 0)
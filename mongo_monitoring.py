@@ -0,0 +1,135 @@
+import time
+import datetime
+import threading
+import collections
+
+from pymongo import monitoring
+
+
+def percentile(values, q):
+	if not values:
+		return None
+	values = sorted(values)
+	return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class CommandStats(monitoring.CommandListener):
+	def __init__(self, maxlen = 500):
+		""" latency and failures of every command the client runs, recent ones kept in a ring buffer """
+		self.lock = threading.Lock()
+		self.recent = collections.deque(maxlen = maxlen)
+		self.totals = dict()
+		return
+
+	def started(self, event):
+		return
+
+	def succeeded(self, event):
+		self.add(event.command_name, event.duration_micros / 1000, None)
+		return
+
+	def failed(self, event):
+		self.add(event.command_name, event.duration_micros / 1000, str(event.failure))
+		return
+
+	def add(self, command_name, duration_ms, error):
+		with self.lock:
+			self.recent.append({
+				'when': datetime.datetime.now(),
+				'command': command_name,
+				'duration (ms)': round(duration_ms, 2),
+				'error': error
+			})
+			t = self.totals.setdefault(command_name, {'count': 0, 'errors': 0, 'total (ms)': 0.0, 'max (ms)': 0.0})
+			t['count'] += 1
+			t['errors'] += error is not None
+			t['total (ms)'] += duration_ms
+			t['max (ms)'] = max(t['max (ms)'], duration_ms)
+		return
+
+	def summary(self):
+		""" one row per command name """
+		with self.lock:
+			rows = list()
+			for command_name, t in self.totals.items():
+				durations = [r['duration (ms)'] for r in self.recent if r['command'] == command_name]
+				rows.append({
+					'command': command_name,
+					'count': t['count'],
+					'errors': t['errors'],
+					'mean (ms)': round(t['total (ms)'] / t['count'], 2),
+					'p95 recent (ms)': percentile(durations, 0.95),
+					'max (ms)': round(t['max (ms)'], 2)
+				})
+			return rows
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+	def __init__(self, maxlen = 500):
+		""" connection pool events, and how long each checkout waited for a connection """
+		self.lock = threading.Lock()
+		self.local = threading.local()
+		self.waits_ms = collections.deque(maxlen = maxlen)
+		self.counts = collections.Counter()
+		return
+
+	def count(self, name):
+		with self.lock:
+			self.counts[name] += 1
+		return
+
+	def connection_check_out_started(self, event):
+		self.local.t0 = time.perf_counter()
+		return
+
+	def connection_checked_out(self, event):
+		t0 = getattr(self.local, 't0', None)
+		if t0 is not None:
+			with self.lock:
+				self.waits_ms.append((time.perf_counter() - t0) * 1000)
+			self.local.t0 = None
+		self.count('checked out')
+		return
+
+	def connection_check_out_failed(self, event):
+		self.local.t0 = None
+		self.count(f'check out failed ({event.reason})')
+		return
+
+	def connection_checked_in(self, event):
+		return
+
+	def connection_created(self, event):
+		self.count('connections created')
+		return
+
+	def connection_ready(self, event):
+		return
+
+	def connection_closed(self, event):
+		self.count('connections closed')
+		return
+
+	def pool_created(self, event):
+		return
+
+	def pool_ready(self, event):
+		return
+
+	def pool_cleared(self, event):
+		self.count('pool cleared')
+		return
+
+	def pool_closed(self, event):
+		return
+
+	def summary(self):
+		with self.lock:
+			waits = list(self.waits_ms)
+			result = dict(self.counts)
+		result.update({
+			'checkout wait p50 (ms)': percentile(waits, 0.5),
+			'checkout wait p95 (ms)': percentile(waits, 0.95),
+			'checkout wait max (ms)': max(waits) if waits else None
+		})
+		return result
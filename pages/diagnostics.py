@@ -0,0 +1,70 @@
+import streamlit as st
+import pandas as pd
+
+import bigquery
+import data_from_cloud
+import functions
+
+st.title("Diagnostics")
+
+st.header(':material/query_stats: BigQuery', divider = True)
+query_metrics = pd.DataFrame(list(bigquery.query_metrics))
+if query_metrics.empty:
+    st.write('No queries yet')
+else:
+    query_metrics = query_metrics.iloc[::-1]
+    cols = st.columns(3)
+    cols[0].metric('Queries', len(query_metrics.index))
+    cols[1].metric('Bytes processed', functions.bytes_to_string(query_metrics['bytes processed'].fillna(0).sum()))
+    cols[2].metric('Cache hits', int(query_metrics['cache hit'].fillna(False).sum()))
+    st.dataframe(query_metrics, hide_index = True)
+
+st.header(':material/cloud_download: Blob cache', divider = True)
+blob_cache_stats = data_from_cloud.blob_cache.stats()
+cols = st.columns(4)
+cols[0].metric('Hits', blob_cache_stats['hits'])
+cols[1].metric('Misses', blob_cache_stats['misses'])
+cols[2].metric('Evictions', blob_cache_stats['evictions'])
+cols[3].metric('Size', f"{functions.bytes_to_string(blob_cache_stats['bytes'])} of {functions.bytes_to_string(blob_cache_stats['max_bytes'])}")
+
+st.header(':material/database: MongoDB', divider = True)
+if 'db' not in st.session_state:
+    st.write('Not connected')
+    st.stop()
+health = st.session_state['db'].health()
+cols = st.columns(4)
+if health['warm up error']:
+    cols[0].metric('Warm up', 'failed')
+    st.error(health['warm up error'])
+elif health['warm up (s)'] is None:
+    cols[0].metric('Warm up', 'running')
+else:
+    cols[0].metric('Warm up', f"{health['warm up (s)']:.2f} s")
+pool = health['pool']
+cols[1].metric('Checkout wait p95', 'n/a' if pool['checkout wait p95 (ms)'] is None else f"{pool['checkout wait p95 (ms)']:.1f} ms")
+cols[2].metric('Connections created', pool.get('connections created', 0))
+cols[3].metric('Command errors', sum(c['errors'] for c in health['commands']))
+
+st.subheader('Commands')
+st.dataframe(pd.DataFrame(health['commands']), hide_index = True)
+st.subheader('Connection pool')
+st.dataframe(pd.DataFrame([pool]), hide_index = True)
+if health['recent errors']:
+    st.subheader('Recent errors')
+    st.dataframe(pd.DataFrame(health['recent errors']).iloc[::-1], hide_index = True)
+
+st.header(':material/sync: Sync to BigQuery', divider = True)
+sync_state = list(st.session_state['db'].db.sync_state.find({}))
+if len(sync_state) <= 0:
+    st.write('sync_daemon.py has not run')
+for s in sync_state:
+    metrics = s.get('metrics', {})
+    cols = st.columns(5)
+    cols[0].metric('Rows synced', metrics.get('rows'))
+    cols[1].metric('Lag', 'n/a' if metrics.get('lag (s)') is None else functions.seconds_to_string(metrics['lag (s)']))
+    cols[2].metric('Rows/s', metrics.get('rows/s recent'))
+    cols[3].metric('Errors', metrics.get('errors'))
+    cols[4].metric('Dead letters', metrics.get('dead letters'), help = 'rows skipped after repeated failures, kept in sync_dead_letter')
+    st.caption(f"{s['_id']}: updated {s.get('updated')}, watermark {metrics.get('watermark')}")
+    if metrics.get('last error'):
+        st.error(metrics['last error'])
@@ -1,6 +1,7 @@
 import streamlit as st
 import datetime
 import event
+import bigquery
 
 st.title("Events")
 
@@ -23,13 +24,15 @@ else:
 
 if 'selected_tool' in st.session_state and st.session_state['selected_tool'] is not None:
     disp_tool_info = st.session_state['selected_tool']
-    disp_tool_info = disp_tool_info.drop(['_id', 'history', 'gps', 'gnss'])
+    disp_tool_info = disp_tool_info.drop(['_id', 'gps', 'gnss'], errors = 'ignore')
     st.dataframe(
         disp_tool_info
     )
     events_data = event.events_df_by_id_and_date_range(st.session_state['selected_tool']['datalogger'], start_date, end_date)
 else:
-    events_data = event.events_df_recent(200, start_date, end_date)
+    # every datalogger, dry run first like the home page queries
+    statement, params = event.events_recent_query(200, start_date, end_date)
+    events_data = bigquery.guarded_query(statement, tuple(params), 'events_recent')
     # st.warning('Please select a tool to view events')
 
 st.dataframe(
@@ -41,7 +44,6 @@ st.dataframe(
         'timestamp': None,
         'timestamp_inserted': None,
         'data': None,
-        'history': None,
         'migrated_to_bigquery': None,
         'minVoltage': None,
         'maxVoltage': None,
@@ -1,5 +1,5 @@
-import plotly.figure_factory
 import streamlit as st
+import os
 import datetime
 import st_aggrid
 import pandas as pd
@@ -11,7 +11,39 @@ from statsmodels.tsa.seasonal import seasonal_decompose
 import bigquery
 import event
 import functions
-import data_from_cloud
+import db_mongo
+import downsample
+import pyramid
+import charts
+import export
+
+
+@st.cache_data(ttl = 60, show_spinner = False)
+def active_tools_info(_db, datalogger_ids, t_last_op):
+    """ db.active_tools per set of dataloggers, t_last_op is only part of the key so edits made here show at once """
+    return _db.active_tools(list(datalogger_ids))
+
+
+def box_to_window(box_x, timezone):
+    """ x range of a plotly box selection, local wall clock strings, to unix seconds """
+    times = [pd.Timestamp(x) for x in box_x]
+    times = [t.tz_localize(timezone) if t.tzinfo is None else t for t in times]
+    return tuple(sorted(t.timestamp() for t in times))
+
+
+def load_raw(server_filenames, timezone, offsets = None):
+    """
+    samples of the event files, read only for a raw plot level, histograms, export or preview
+    offsets: {column: value} added to cumulative columns when only the later files of a selection are read
+    """
+    df, errors = event.load_selected_events(tuple(server_filenames), timezone)
+    for server_filename, e in errors:
+        st.warning(f'Skipped {server_filename}: {e}')
+    if df is not None and offsets:
+        # the memoized df is shared, assign makes a copy
+        df = df.assign(**{c: df[c] + offset for c, offset in offsets.items() if c in df.columns})
+    return df
+
 
 st.title('Home')
 
@@ -36,32 +68,29 @@ start_date, end_date = date_range
 # -----
 st.header(f':material/earthquake: Active Tools {start_date} to {end_date}', divider = True)
 
-# start with info from events in bigquery
-query = (f"SELECT "
+# start with info from the events_daily rollup in bigquery, today from events
+daily, rollup_params = bigquery.daily_usage()
+query = (f"WITH {daily} "
+         f"SELECT "
          f"`datalogger`, "
-         f"SUM(duration) as sum_duration, "
-         f"ROUND(SUM(CASE WHEN avgCurrent >=0 THEN energy ELSE 0 END), 0) AS `Discharged Wh`, "
-         f"ROUND(SUM(CASE WHEN avgCurrent <0 THEN energy ELSE 0 END), 0) AS `Charged Wh`, "
+         f"SUM(sum_duration) as sum_duration, "
+         f"ROUND(SUM(discharged_wh), 0) AS `Discharged Wh`, "
+         f"ROUND(SUM(charged_wh), 0) AS `Charged Wh`, "
          f"MAX(date) as `Last Active` "
-         f"FROM `{st.secrets['bigquery_project_id']}.{st.secrets['bigquery_dataset']}.events` "
-         f"WHERE `date` >= \"{start_date}\" AND `date` <= \"{end_date}\" "
+         f"FROM daily "
          f"GROUP BY `datalogger` "
          f"ORDER BY `Last Active` DESC "
          )
-active_tools = bigquery.df_from_query(query)
+date_range_params = (
+    ('start_date', 'DATE', start_date),
+    ('end_date', 'DATE', end_date)
+)
+active_tools = bigquery.guarded_query(query, date_range_params + rollup_params, 'home.active_tools')
 active_tools['Total Time'] = active_tools.apply(lambda row: functions.seconds_to_string(row['sum_duration']), axis = 1)
 
-# add info from tools in mongodb
-tools_data = db.df(db.tools.find())
-tools_data = tools_data.drop(columns = ['_id', 'history',])
+# add info from tools and their users in mongodb, joined there
+tools_data = active_tools_info(db, tuple(sorted(active_tools['datalogger'].unique())), db.t_last_op)
 active_tools = pd.merge(active_tools, tools_data, on = 'datalogger', how = 'left')
-active_tools['Tool Name'] = active_tools['model'] + ' ' + active_tools['SN']
-
-# add info from users in mongodb
-users_data = db.df(db.users.find())
-users_data = users_data[['_id', 'name']]
-active_tools = pd.merge(active_tools, users_data, left_on = 'user', right_on = '_id', how = 'left')
-active_tools = active_tools.drop(columns = ['user'])
 
 gob = st_aggrid.GridOptionsBuilder.from_dataframe(active_tools)
 gob.configure_default_column(
@@ -76,35 +105,24 @@ gob.configure_column(
 )
 gob.configure_column("Last Active", type=["customDateTimeFormat"], custom_format_string='yyyy-MM-dd')
 columns_to_hide = [
-    'sum_duration', '_id', 'history',
-    'gps', 'gnss',
-    'shape_height_in', 'shape_width_in',
-    'Tool Name', 'schedule',
+    'sum_duration',
+    'Tool Name',
     'timezone', 'hotspot'
 ]
 for c in columns_to_hide:
     gob.configure_column(c, hide = True)
 
+# the columns from mongodb are typed by db.active_tools, only the bigquery ones need it
 col_types = {
-    'datalogger': 'str',
-    'Last Active': 'str',
-    'Total Time': 'str',
-    'brand': 'str',
-    'model': 'str',
-    'description': 'str',
-    'SN': 'str',
-    'timezone': 'str',
-    'hotspot': 'str',
-    'name': 'str',
-    'Tool Name': 'str',
-    'Charged Wh': 'float',
-    'Discharged Wh': 'float',
-    'sum_duration': 'float'
+    'datalogger': 'string',
+    'Last Active': 'string',
+    'Total Time': 'string',
+    'Charged Wh': 'float64',
+    'Discharged Wh': 'float64',
+    'sum_duration': 'float64'
 }
-for k, v in col_types.items():
-    active_tools[k] = active_tools[k].astype(v)
-
-active_tools = active_tools.replace({None: '', 'nan': ''})
+active_tools = active_tools.astype(col_types)
+active_tools = active_tools.fillna({c: '' for c in db_mongo.ACTIVE_TOOL_COLUMNS})
 
 active_tools_cols = st.columns([0.6, 0.4])
 with active_tools_cols[0]:
@@ -119,7 +137,6 @@ with active_tools_cols[0]:
 with active_tools_cols[1]:
     active_tools_plot_df = active_tools.copy()
     active_tools_plot_df = active_tools_plot_df.sort_values(by = 'sum_duration', ascending = False)
-    active_tools_plot_df = active_tools_plot_df.drop(columns = ['schedule', 'gnss', 'gps'])
 
     active_tools_plot = px.bar(
         active_tools_plot_df,
@@ -141,17 +158,18 @@ selected_tool = active_tools_selection.selected_data.iloc[0]
 # ------
 st.header(f":material/calendar_month: Usage by Day: {selected_tool['brand']} {selected_tool['model']} {selected_tool['SN']}", divider = True)
 
-query = (f"SELECT "
+daily, rollup_params = bigquery.daily_usage('AND datalogger = @datalogger')
+query = (f"WITH {daily} "
+         f"SELECT "
          f"date, "
-         f"SUM(duration) as sum_duration, "
-         f"SUM(CASE WHEN avgCurrent >=0 THEN energy ELSE 0 END) AS `Energy Wh Discharged`, "
-         f"SUM(CASE WHEN avgCurrent <0 THEN energy ELSE 0 END) AS `Energy Wh Charged`, "
-         f"FROM `{st.secrets['bigquery_project_id']}.{st.secrets['bigquery_dataset']}.events` "
-         f"WHERE `datalogger` = \"{selected_tool['datalogger']}\" AND `date` >= \"{start_date}\" AND `date` <= \"{end_date}\" "
+         f"SUM(sum_duration) as sum_duration, "
+         f"SUM(discharged_wh) AS `Energy Wh Discharged`, "
+         f"SUM(charged_wh) AS `Energy Wh Charged`, "
+         f"FROM daily "
          f"GROUP BY `date` "
          f"ORDER BY `date` ASC "
          )
-data_by_date = bigquery.df_from_query(query)
+data_by_date = bigquery.guarded_query(query, (('datalogger', 'STRING', selected_tool['datalogger']),) + date_range_params + rollup_params, 'home.usage_by_day')
 data_by_date['Total Time'] = data_by_date.apply(lambda row: functions.seconds_to_string(row['sum_duration']), axis = 1)
 data_by_date['date'] = pd.to_datetime(data_by_date['date'])
 
@@ -218,21 +236,14 @@ selected_date = datetime.datetime.strptime(selected_date, "%Y-%m-%dT%H:%M:%S").d
 # -----
 st.header(f':material/event_note: Events with {selected_tool['brand']} {selected_tool['model']} {selected_tool['SN']} on {selected_date}', divider = True)
 
-events_data = event.events_df_by_id_and_date_range(selected_tool['datalogger'], start_date = selected_date, end_date = selected_date)
-
-# combine adjacent events into "sessions"
-dfs_by_session = event.combine_adjacent_events(events_data, timeout_s = 120)
-if len(dfs_by_session) == 1 and dfs_by_session[0].empty:
-    st.warning('Empty dataframe')
-    st.write('events_data')
-    st.write(events_data)
-    st.write('dfs_by_session')
-    st.write(dfs_by_session)
-    st.stop()
-dfs_by_session_and_charging = event.split_events_by_charging(dfs_by_session)
 if not selected_tool['timezone'] or not isinstance(selected_tool['timezone'], str) or selected_tool['timezone'] == 'nan':
     selected_tool['timezone'] = 'UTC'
-events_data = event.events_list_summarized(dfs_by_session_and_charging, selected_tool['timezone'])
+
+# combine adjacent events into "sessions", split by charging, cached per (datalogger, date)
+events_data = event.summarized_events_by_id_and_date(selected_tool['datalogger'], selected_date, selected_tool['timezone'], timeout_s = 120)
+if events_data.empty:
+    st.warning('No events found')
+    st.stop()
 
 gob = st_aggrid.GridOptionsBuilder.from_dataframe(events_data)
 gob.configure_selection(
@@ -246,7 +257,7 @@ gob.configure_column(
     # headerCheckboxSelection = True, checkboxSelection = False,
     type = ["customDateTimeFormat"], custom_format_string='yyyy-MM-dd hh:mm:ss a (z)'
 )
-columns_to_hide = ['date', 'filenames', 'Duration (s)'] #  'timestamp',
+columns_to_hide = ['date', 'filenames', 'Duration (s)', 'End timestamp'] #  'timestamp',
 for col in columns_to_hide:
     gob.configure_column(col, hide = True)
 
@@ -292,36 +303,24 @@ with events_plot_cols[0]:
     # st.write(events_data_selection.selected_data[['Time (local)', 'Duration', 'Energy (Wh)']])
 
     with st.spinner('Downloading files...', show_time = True):
-        dfs = list()
+        server_filenames = list()
         for index, ev in events_data_selection.selected_data.iterrows():
-            ev['filenames'] = ast.literal_eval(ev['filenames'])
-            for server_filename in ev['filenames']:
-                local_filename = data_from_cloud.download_blob_by_name(server_filename)
-
-                try:
-                    df = pd.read_csv(local_filename)
-                except pd.errors.EmptyDataError as e:
-                    print(local_filename, 'error', e)
-                    continue
-                df = event.harmonize_columns(df)
-                timestamp = event.timestamp_from_filename(local_filename)
-                df['t (s)'] = df['t (s)'] + timestamp
-                df['time'] = pd.to_datetime(df['t (s)'], unit = 's', utc = True)
-                df['time'] = df['time'].dt.tz_convert(selected_tool['timezone'])
-                df = event.fix_energy_values(df)
-                df = functions.remove_outliers(df, ['current (A)'], 6) # remove extreme outliers
-                dfs.append(df)
-
-        if len(dfs) == 0:
-            st.stop()
+            server_filenames.extend(ast.literal_eval(ev['filenames']))
 
-        df = pd.concat(dfs)
-        df = event.fix_energy_values(df)
+        # the coarsest pyramid level of every file, the samples are only read when needed
+        server_filenames = tuple(server_filenames)
+        overview_df, errors = pyramid.load(server_filenames, selected_tool['timezone'], pyramid.LEVELS[-1])
+        for server_filename, e in errors:
+            st.warning(f'Skipped {server_filename}: {e}')
+
+        if overview_df.empty:
+            st.stop()
+        variables = pyramid.variables(overview_df)
 
 
     plot_vars = st.multiselect(
         'Plot variables',
-        options = df.columns.tolist(),
+        options = variables,
         default = 'current (A)'
     )
 
@@ -332,103 +331,190 @@ with events_plot_cols[0]:
         selection_mode = 'single'
     )
 
+    downsample_mode = st.segmented_control(
+        'Downsampling',
+        options = downsample.MODES,
+        format_func = lambda m: {'minmax': 'Min/max', 'lttb': 'LTTB'}[m],
+        default = 'minmax',
+        selection_mode = 'single'
+    ) or 'minmax'
+
 
 with events_plot_cols[1]:
     with st.spinner('Plotting data...', show_time = True):
-        if resample_rate == 'Original':
-            df_resample = df
-        else:
-            df_resample = df.copy()
-            df_resample['timedelta'] = pd.to_timedelta(df['t (s)'], unit = 's')
-            df_resample = df_resample.resample(f'{float(resample_rate)}s', on = 'timedelta').max()
-
-        # avoid huge plots that freeze the client
+        # avoid huge plots that freeze the client, the bucket width comes from the point budget
         max_num_points = 1.0e5
-        resample_rate_increment = 0.1
-        resample_rate_override = resample_rate
-        while df_resample['t (s)'].size * len(plot_vars) > max_num_points:
-            if not isinstance(resample_rate_override, float):
-                resample_rate_override = 0.0
-            resample_rate_override = round(float(resample_rate_override) + resample_rate_increment, 2)
-            df_resample = df.copy()
-            df_resample['timedelta'] = pd.to_timedelta(df['t (s)'], unit='s')
-            df_resample = df_resample.resample(f'{float(resample_rate_override)}s', on = 'timedelta').max()
-
-        if resample_rate_override != resample_rate:
-            st.write(f'Resample rate increased to {resample_rate_override}s to maintain plotting speed')
-
+        min_width = None if resample_rate in (None, 'Original') else float(resample_rate)
         x_var = 'time'
 
-        fig = plotly.graph_objs.Figure()
-
-        for plot_var in plot_vars:
-            fig.add_scatter(
-                x = df_resample[x_var],
-                y = df_resample[plot_var],
-                name = plot_var,
-                mode = 'lines',
-            )
-
-            if False:
-                df_for_decomp = df_resample.copy()
-                df_for_decomp = df_for_decomp.dropna(axis = 'rows')
-                decomp_period = math.floor(len(df_for_decomp.index) / 10)
-                decomp_period = min(decomp_period, 365*24*60)
-                decomposed = seasonal_decompose(
-                    x = df_for_decomp[plot_var],
-                    model = 'additive',
-                    period = decomp_period
-                )
-                fig.add_scatter(
-                    x = df_for_decomp[x_var],
-                    y = decomposed.trend,
-                    name = f'{plot_var} trend',
-                    mode = 'lines',
-                )
-
-                fig.add_scatter(
-                    x = df_for_decomp[x_var],
-                    y = decomposed.seasonal + decomposed.resid,
-                    name = f'{plot_var} s+r',
-                    mode = 'lines',
-                )
-
-        # add vertical line for each event beginning
-        for index, ev in events_data_selection.selected_data.iterrows():
-            fig.add_vline(x = ev['Time (local)'], line_width = 1, line_dash = "dot", line_color = "#dbdbdb")
+        # a box selected on the plot zooms in, finer data is loaded for the window
+        plot_files = tuple(server_filenames)
+        if st.session_state.get('events_plot_files') != plot_files:
+            st.session_state['events_plot_files'] = plot_files
+            st.session_state['events_plot_window'] = None
+            st.session_state['events_plot_zoom'] = 0
+        selected_events = events_data_selection.selected_data
+        window = st.session_state['events_plot_window'] or (
+            float(selected_events['timestamp'].astype(float).min()),
+            float(selected_events['End timestamp'].astype(float).max())
+        )
 
-        fig.update_xaxes(tickformat = '%I:%M:%S %p')
-        st.plotly_chart(
-            fig
+        # long windows plot a pyramid level, short ones the samples
+        level_df = pd.DataFrame()
+        if plot_vars:
+            level = pyramid.choose_level(window[1] - window[0], len(plot_vars), max_num_points, min_width)
+            level_df, _ = pyramid.load(server_filenames, selected_tool['timezone'], level, window)
+        n_samples = int(level_df['n'].sum()) if 'n' in level_df.columns else 0
+
+        traces = list()
+
+        if not plot_vars:
+            st.write('Select variables to plot')
+        elif level_df.empty:
+            # e.g. a box over the idle time between sessions
+            st.write('No samples in this range')
+        elif n_samples * len(plot_vars) <= max_num_points:
+            # only the files of the window are read
+            window_files, offsets = pyramid.raw_files(server_filenames, level_df, overview_df)
+            df = load_raw(window_files, selected_tool['timezone'], offsets)
+            if df is None:
+                st.stop()
+            df_window = df[(df['t (s)'] >= window[0]) & (df['t (s)'] <= window[1])]
+            df_resample, width = downsample.downsample(df_window, 't (s)', plot_vars, max_num_points, downsample_mode, min_width)
+
+            if width is not None and (min_width is None or width > min_width):
+                st.write(f'Resample rate increased to {width:.2g}s to maintain plotting speed')
+
+            for plot_var in plot_vars:
+                traces.append(charts.scatter(
+                    x = df_resample[x_var],
+                    y = df_resample[plot_var],
+                    name = plot_var
+                ))
+
+                if False:
+                    df_for_decomp = df_resample.copy()
+                    df_for_decomp = df_for_decomp.dropna(axis = 'rows')
+                    decomp_period = math.floor(len(df_for_decomp.index) / 10)
+                    decomp_period = min(decomp_period, 365*24*60)
+                    decomposed = seasonal_decompose(
+                        x = df_for_decomp[plot_var],
+                        model = 'additive',
+                        period = decomp_period
+                    )
+                    traces.append(charts.scatter(
+                        x = df_for_decomp[x_var],
+                        y = decomposed.trend,
+                        name = f'{plot_var} trend'
+                    ))
+
+                    traces.append(charts.scatter(
+                        x = df_for_decomp[x_var],
+                        y = decomposed.seasonal + decomposed.resid,
+                        name = f'{plot_var} s+r'
+                    ))
+        else:
+            st.write(f'Showing min, max and mean every {level}s, select a range on the plot to zoom in')
+            for plot_var in plot_vars:
+                if f'{plot_var} mean' not in level_df.columns:
+                    continue
+                traces.append(charts.scatter(
+                    x = level_df[x_var], y = level_df[f'{plot_var} max'],
+                    name = f'{plot_var} max', legendgroup = plot_var, showlegend = False,
+                    line_width = 0
+                ))
+                traces.append(charts.scatter(
+                    x = level_df[x_var], y = level_df[f'{plot_var} min'],
+                    name = f'{plot_var} min', legendgroup = plot_var, showlegend = False,
+                    line_width = 0, fill = 'tonexty'
+                ))
+                traces.append(charts.scatter(
+                    x = level_df[x_var], y = level_df[f'{plot_var} mean'],
+                    name = plot_var, legendgroup = plot_var
+                ))
+
+        # vertical line for each event beginning, one shapes list
+        fig = charts.figure(
+            traces,
+            shapes = charts.vlines(events_data_selection.selected_data['Time (local)']),
+            xaxis = {'tickformat': '%I:%M:%S %p'},
+            dragmode = 'select',
+            selectdirection = 'h'
         )
+        events_plot = st.plotly_chart(
+            fig,
+            on_select = 'rerun',
+            selection_mode = 'box',
+            key = f"events_plot_{st.session_state['events_plot_zoom']}"
+        )
+
+        boxes = events_plot.selection.get('box', []) if events_plot else []
+        if boxes:
+            st.session_state['events_plot_window'] = box_to_window(boxes[0]['x'], selected_tool['timezone'])
+            st.session_state['events_plot_zoom'] += 1 # a new chart, without the selection
+            st.rerun()
+        if st.session_state['events_plot_window'] is not None and st.button('Reset zoom', icon = ':material/zoom_out:'):
+            st.session_state['events_plot_window'] = None
+            st.session_state['events_plot_zoom'] += 1
+            st.rerun()
 
         hist_vars = st.multiselect(
             'Histogram variables',
-            options = df.columns.tolist(),
-            default = 'current (A)'
+            options = variables,
+            default = [v for v in ['current (A)'] if v in variables]
         )
 
-        for y_var in hist_vars:
-            bin_width = 5
-            nbins = math.ceil((df[y_var].max() - df[y_var].min()) / bin_width)
-            hist = px.histogram(
-                df,
-                y = 'dt (s)',
-                x = y_var,
-                marginal = 'box',
-                nbins = nbins
-            )
-            st.plotly_chart(hist, key = f'hist-{y_var}')
+        # the samples of the whole selection are only read once a histogram is asked for
+        df = load_raw(server_filenames, selected_tool['timezone']) if hist_vars else None
+        if df is not None:
+            for y_var in hist_vars:
+                # binned here, only the bin sums and box statistics go to the browser
+                hist = charts.histogram(
+                    df[y_var],
+                    weights = df['dt (s)'],
+                    bin_width = 5,
+                    x_title = y_var,
+                    y_title = 'sum of dt (s)'
+                )
+                st.plotly_chart(hist, key = f'hist-{y_var}')
 
 with events_plot_cols[0]:
-    st.subheader('Download CSV of selected events')
+    st.subheader('Download selected events')
     selected_event = events_data_selection.selected_data.iloc[0]
+    export_name = f"{selected_event['Time (local)']} {selected_tool['datalogger']} {selected_tool['brand']} {selected_tool['model']} {selected_tool['SN']}"
 
-    st.download_button(
-        label = "Download CSV",
-        data = df.to_csv(index = False).encode('utf-8'),
-        file_name = f"{selected_event['Time (local)']} {selected_tool['datalogger']} {selected_tool['brand']} {selected_tool['model']} {selected_tool['SN']}.csv",
-        mime = "text/csv",
-        key = 'download-csv'
-    )
-    st.dataframe(df)
\ No newline at end of file
+    # the file is only written when asked for, and kept until the selection or format changes
+    export_format = st.segmented_control(
+        'Format',
+        options = list(export.FORMATS),
+        default = 'csv.gz',
+        selection_mode = 'single'
+    ) or 'csv.gz'
+    export_key = (plot_files, export_format)
+    if st.button('Prepare download', icon = ':material/file_export:'):
+        with st.spinner('Writing file...', show_time = True):
+            df = load_raw(server_filenames, selected_tool['timezone'])
+            if df is not None:
+                st.session_state['events_export'] = (export_key, export.write(df, export_format))
+
+    prepared = st.session_state.get('events_export')
+    if prepared and prepared[0] == export_key and os.path.exists(prepared[1]):
+        extension, mime = export.FORMATS[export_format]
+        with open(prepared[1], 'rb') as f:
+            st.download_button(
+                label = f"Download {export_format} ({functions.bytes_to_string(os.path.getsize(prepared[1]))})",
+                data = f,
+                file_name = export_name + extension,
+                mime = mime,
+                key = 'download-csv'
+            )
+
+    if st.toggle('Preview samples'):
+        df = load_raw(server_filenames, selected_tool['timezone'])
+        if df is not None:
+            preview_page_size = 1000
+            preview_pages = export.n_pages(df, preview_page_size)
+            preview_page = 1
+            if preview_pages > 1:
+                preview_page = st.number_input(f'Preview page, of {preview_pages}', min_value = 1, max_value = preview_pages, value = 1)
+            st.dataframe(export.page(df, preview_page - 1, preview_page_size))
@@ -30,6 +30,12 @@ def user_name_from_schedule(users, schedule):
     return schedule[-1]['User']
 
 
+@st.cache_data(ttl = 60, show_spinner = False)
+def tools_last_updated(_db, t_last_op):
+    """ db.audit.last_updated('tools'), t_last_op is only part of the key so edits made here show at once """
+    return _db.audit.last_updated('tools')
+
+
 st.title("Tools")
 
 if 'db' not in st.session_state:
@@ -37,15 +43,15 @@ if 'db' not in st.session_state:
     st.stop()
 
 db = st.session_state["db"]
-tools_data = db.df(db.tools.find())
-tools_data['_id'] = tools_data['_id'].astype(str) # weird bug, db.df should already be doing this
+reference_cache = st.session_state['reference_cache']
+tools_data = reference_cache.df('tools')
 
-users = db.df(db.users.find())
-users['_id'] = users['_id'].astype(str)
+users = reference_cache.df('users')
 users = users.sort_values('name').reset_index()
 
 tools_data['User Name'] = tools_data['schedule'].apply(lambda x: user_name_from_schedule(users, x))
-tools_data['Last Updated'] = tools_data['history'].apply(lambda x: x[-1]['when'].strftime('%m-%d-%Y %I:%M:%S %p') if len(x) > 0 else '')
+last_updated = tools_last_updated(db, db.t_last_op)
+tools_data['Last Updated'] = tools_data['_id'].map(lambda x: last_updated[x].strftime('%m-%d-%Y %I:%M:%S %p') if x in last_updated else '')
 
 gob = st_aggrid.GridOptionsBuilder.from_dataframe(tools_data)
 gob.configure_default_column(
@@ -55,7 +61,7 @@ gob.configure_default_column(
 )
 gob.configure_selection('single', use_checkbox = False)
 
-columns_to_hide = ['_id', 'history', 'gps', 'gnss', 'shape_height_in', 'shape_width_in', 'user', 'schedule']
+columns_to_hide = ['_id', 'gps', 'gnss', 'shape_height_in', 'shape_width_in', 'user', 'schedule']
 for c in columns_to_hide:
     gob.configure_column(c, hide = True)
 
@@ -99,10 +105,6 @@ for text_field in text_fields:
 if 'schedule' not in tool or isinstance(tool['schedule'], float):
     tool['schedule'] = [{'User': '', 'Start Date': None, 'End Date': None, 'Timezone': ''}]
 
-if 'history' not in tool: #  or not isinstance(tool['history'], list)
-    tool['history'] = list()
-tool['history'] = ast.literal_eval(tool['history'])
-
 tool = tool.fillna('')
 tool = tool.replace({None: ''})
 
@@ -167,7 +169,7 @@ with tool_cols[0]:
     if submit_sch:
         sch_val = sch_val.replace({pd.NaT: None})
         sch_list = sch_val.to_dict(orient = 'records')
-        db.update(collection = 'tools', _id = tool['_id'], data = {'schedule': sch_list})
+        changes = db.update(collection = 'tools', _id = tool['_id'], data = {'schedule': sch_list})
 
         st.markdown(
             """
@@ -180,7 +182,7 @@ with tool_cols[0]:
             """,
             unsafe_allow_html = True
         )
-        st.toast(f'Updated schedule for {tool['brand']} {tool['model']} {tool['SN']}', icon = ':material/event_available:')
+        st.toast(f'Updated schedule for {tool['brand']} {tool['model']} {tool['SN']}' if changes else 'No schedule changes', icon = ':material/event_available:')
 
 
 
@@ -204,7 +206,7 @@ with tool_cols[1]:
         submitted = st.form_submit_button("Submit")
         if submitted:
             with st.spinner('Updating tool info...', show_time = True):
-                db.update(collection = 'tools', _id = tool['_id'], data = vals)
+                changes = db.update(collection = 'tools', _id = tool['_id'], data = vals)
 
             st.markdown(
                 """
@@ -217,13 +219,17 @@ with tool_cols[1]:
                 """,
                 unsafe_allow_html = True
             )
-            st.toast('Tool info updated', icon = ':material/task:')
+            st.toast('Tool info updated' if changes else 'No changes', icon = ':material/task:')
 
             st.rerun()
 
     with st.expander('Change history'):
-        for row in tool['history'][::-1]:
-            when = datetime.datetime.strptime(row['when'], "%Y-%m-%dT%H:%M:%S.%f")
+        history_pages = db.history_pages('tools', tool['_id'])
+        history_page = 1
+        if history_pages > 1:
+            history_page = st.number_input('Page', min_value = 1, max_value = history_pages, value = 1, key = 'tool_history_page')
+        for row in db.get_history('tools', tool['_id'], page = history_page - 1):
+            when = row['when']
             with st.container():
                 cols = st.columns([.3, .7])
                 with cols[0]:
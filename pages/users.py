@@ -2,7 +2,6 @@ import streamlit as st
 from st_keyup import st_keyup
 import st_aggrid
 import datetime
-import ast
 
 st.title("Users")
 
@@ -11,9 +10,9 @@ if 'db' not in st.session_state:
     st.stop()
 
 db = st.session_state["db"]
+reference_cache = st.session_state['reference_cache']
 
-users_data = db.df(db.users.find())
-users_data['_id'] = users_data['_id'].astype(str)
+users_data = reference_cache.df('users')
 users_data = users_data.sort_values('name')
 
 gob = st_aggrid.GridOptionsBuilder.from_dataframe(users_data)
@@ -33,7 +32,7 @@ if 'new_user_id' in st.session_state:
 
 gob.configure_selection('single', use_checkbox = False, pre_selected_rows = sel_index)
 
-columns_to_hide = ['history'] #  '_id',
+columns_to_hide = [] #  '_id',
 for c in columns_to_hide:
     gob.configure_column(c, hide = True)
 
@@ -66,10 +65,6 @@ if event.selected_data is None or event.selected_data.empty:
 user = event.selected_data.iloc[0]
 user = user.replace('nan', '')
 
-if 'history' not in user:
-    user['history'] = list()
-user['history'] = ast.literal_eval(user['history'])
-
 with user_cols[1]:
     with st.form('users_form') as form:
         st.subheader('Update User Info')
@@ -87,8 +82,7 @@ with user_cols[1]:
         if submitted:
             with st.spinner('Updating user info...', show_time = True):
                 # st.write(vals)
-                db.update(collection = 'users', _id = user['_id'], data = vals)
-                users_data = db.df(db.users.find())
+                changes = db.update(collection = 'users', _id = user['_id'], data = vals)
 
             st.markdown(
                 """
@@ -101,12 +95,16 @@ with user_cols[1]:
                 """,
                 unsafe_allow_html = True
             )
-            st.toast(f'Updated info for {user['name']}', icon = ':material/person_add:')
+            st.toast(f'Updated info for {user['name']}' if changes else 'No changes', icon = ':material/person_add:')
             st.rerun()
 
     with st.expander('Change history'):
-        for row in user['history'][::-1]:
-            when = datetime.datetime.strptime(row['when'], "%Y-%m-%dT%H:%M:%S.%f")
+        history_pages = db.history_pages('users', user['_id'])
+        history_page = 1
+        if history_pages > 1:
+            history_page = st.number_input('Page', min_value = 1, max_value = history_pages, value = 1, key = 'user_history_page')
+        for row in db.get_history('users', user['_id'], page = history_page - 1):
+            when = row['when']
             with st.container():
                 cols = st.columns([.3, .7])
                 with cols[0]:
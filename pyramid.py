@@ -0,0 +1,147 @@
+"""
+multi-resolution pyramid of an event file, for plotting long sessions without the raw samples
+every level is the event cut in buckets of a fixed width, with the min, max and mean of each variable
+stored next to the cached csv as <csv>.pyramid.parquet, built on first use
+"""
+import os
+
+import numpy as np
+import pandas as pd
+from memoization import cached
+
+import functions
+import data_from_cloud
+import event
+
+
+LEVELS = (0.01, 0.1, 1, 10) # bucket widths in seconds, finest first
+AGGREGATIONS = ('min', 'max', 'mean')
+# cumulative, their last value offsets the next file when files are concatenated
+CUMULATIVE_COLUMNS = ('energy (J)', 'energy (Wh)')
+SKIP_COLUMNS = ('t (s)', 'dt (us)', 'dt (s)')
+# the aggregates of a column may be float32 like the column itself, cumulative ones stay float64
+DOWNCAST_ATOL = {f'{c} {a}': tolerance for c, tolerance in event.DOWNCAST_ATOL.items() for a in AGGREGATIONS}
+
+
+def pyramid_filename(local_filename):
+	return local_filename + '.pyramid.parquet'
+
+
+def build(df, levels = LEVELS):
+	"""
+	long frame of all levels: level, t (s) of the bucket start, n samples, then '<var> min', '<var> max', '<var> mean'
+	and '<var> last' for CUMULATIVE_COLUMNS
+	df: event frame with t (s) from the start of the event
+	"""
+	columns = [c for c in df.columns if c not in SKIP_COLUMNS and pd.api.types.is_numeric_dtype(df[c])]
+	t = df['t (s)'].to_numpy(dtype = 'float64')
+	frames = list()
+	for width in levels:
+		bucket = np.floor(t / width).astype('int64')
+		grouped = df[columns].groupby(bucket, sort = True)
+		agg = grouped.agg(list(AGGREGATIONS))
+		agg.columns = [f'{c} {a}' for c, a in agg.columns]
+		for c in CUMULATIVE_COLUMNS:
+			if c in columns:
+				agg[f'{c} last'] = grouped[c].last()
+		agg = event.downcast_floats(agg.astype('float64'), atol = DOWNCAST_ATOL)
+		agg.insert(0, 'n', grouped.size().astype('int32'))
+		agg.insert(0, 't (s)', agg.index.to_numpy() * width)
+		agg.insert(0, 'level', width)
+		frames.append(agg.reset_index(drop = True))
+	p = pd.concat(frames, ignore_index = True)
+	p.attrs['event_frame_version'] = event.EVENT_FRAME_VERSION # kept in the parquet metadata
+	return p
+
+
+def read(local_filename):
+	""" the pyramid of a downloaded event file, built and saved first when missing, older than the file or of another version """
+	filename = pyramid_filename(local_filename)
+	try:
+		if os.path.getmtime(filename) >= os.path.getmtime(local_filename):
+			p = pd.read_parquet(filename)
+			if p.attrs.get('event_frame_version') == event.EVENT_FRAME_VERSION:
+				return p
+	except OSError:
+		pass
+	p = build(event.clean_event_frame(local_filename))
+	functions.save_parquet(filename, p)
+	return p
+
+
+def variables(p):
+	""" the variables aggregated in the load() frame p """
+	return [c[:-len(' mean')] for c in p.columns if c.endswith(' mean')]
+
+
+def raw_files(server_filenames, window_df, overview_df):
+	"""
+	the consecutive server_filenames with buckets in window_df, a load() frame of a window,
+	and the cumulative values at the end of the files before them, from overview_df, a load() frame of all files
+	so a zoomed window reads only its own files raw
+	returns (server_filenames tuple, {column: offset}), no files when the window has no buckets
+	"""
+	if window_df.empty:
+		return tuple(), dict()
+	first, last = int(window_df['file'].min()), int(window_df['file'].max())
+	before = overview_df[overview_df['file'] < first] if 'file' in overview_df.columns else overview_df.iloc[0:0]
+	offsets = dict()
+	for c in CUMULATIVE_COLUMNS:
+		if f'{c} last' in before.columns and not before.empty:
+			offsets[c] = float(before[f'{c} last'].iloc[-1])
+	return tuple(server_filenames[first:last + 1]), offsets
+
+
+def choose_level(window_s, n_vars, max_points, min_width = None):
+	""" finest level whose min, max and mean of n_vars over window_s stay under max_points """
+	for width in LEVELS:
+		if min_width and width < float(min_width):
+			continue
+		if window_s / width * n_vars * len(AGGREGATIONS) <= max_points:
+			return width
+	return LEVELS[-1]
+
+
+@cached(max_size = 16, ttl = 15*60)
+def load(server_filenames, timezone, level, window = None, max_workers = 8):
+	"""
+	one level of the pyramids of many event files, concatenated in order with unix t (s), local time
+	and file, the position of the bucket's file in server_filenames
+	server_filenames: tuple, results are memoized per (files, timezone, level, window), do not modify them
+	window: (t0, t1) unix seconds, buckets outside it are left out
+	returns (df, errors), errors like event.load_event_files
+	"""
+	frames = list()
+	errors = list()
+	downloads = data_from_cloud.download_blobs_by_name(server_filenames, max_workers = max_workers)
+	results = dict()
+	for i, server_filename, local_filename, error in downloads:
+		if error is None:
+			try:
+				p = read(local_filename)
+				p = event.add_time(p[p['level'] == level].drop(columns = ['level']), local_filename, timezone)
+				p['file'] = i
+				results[i] = p
+				continue
+			except (pd.errors.EmptyDataError, ValueError, KeyError) as e:
+				error = e
+		print(server_filename, 'error', error)
+		errors.append((i, server_filename, error))
+
+	offsets = dict.fromkeys(CUMULATIVE_COLUMNS, 0.0)
+	for i in sorted(results):
+		p = results[i]
+		for c, offset in offsets.items():
+			if f'{c} last' not in p.columns or p.empty:
+				continue
+			for a in AGGREGATIONS + ('last',):
+				p[f'{c} {a}'] = p[f'{c} {a}'] + offset
+			offsets[c] = float(p[f'{c} last'].iloc[-1])
+		if window is not None:
+			p = p[(p['t (s)'] >= window[0] - level) & (p['t (s)'] <= window[1])]
+		frames.append(p)
+
+	errors = [(server_filename, error) for i, server_filename, error in sorted(errors, key = lambda e: e[0])]
+	if len(frames) <= 0:
+		return pd.DataFrame(), errors
+	return pd.concat(frames, ignore_index = True), errors
@@ -0,0 +1,114 @@
+import time
+import threading
+
+import pymongo.errors
+
+
+class ReferenceCache():
+	def __init__(self, db, collections = ('tools', 'users'), watch = True, poll_interval_s = 5, refresh_interval_s = 5 * 60):
+		"""
+		process-wide cache of small collections as DataFrames, loaded with db.df(collection)
+		kept current from a background thread by a change stream,
+		or where change streams are unavailable (standalone mongod, mongomock) by polling signal(),
+		which sees writes from other app processes too, and reloading everything every refresh_interval_s
+		writes through db.insert / db.update invalidate immediately
+		db: DB_Handler
+		"""
+		self.db = db
+		self.collections = tuple(collections)
+		self.poll_interval_s = poll_interval_s
+		self.refresh_interval_s = refresh_interval_s
+
+		self.lock = threading.Lock()
+		self.frames = dict()
+		self.stale = set(self.collections)
+		self.mode = None
+		self.t_last_op = db.t_last_op
+		self.stop_event = threading.Event()
+
+		db.listeners.append(self.invalidate)
+		self.thread = threading.Thread(target = self.run, args = (watch,), name = 'reference_cache', daemon = True)
+		self.thread.start()
+		return
+
+	def df(self, collection):
+		""" copy of the cached DataFrame, reloaded first if it is stale """
+		with self.lock:
+			if collection in self.stale or collection not in self.frames:
+				self.frames[collection] = self.db.df(collection)
+				self.stale.discard(collection)
+			return self.frames[collection].copy()
+
+	def invalidate(self, collection = None):
+		""" mark collection stale, all collections if None """
+		with self.lock:
+			if collection is None:
+				self.stale.update(self.collections)
+			elif collection in self.collections:
+				self.stale.add(collection)
+		return
+
+	def run(self, watch):
+		while watch and not self.stop_event.is_set():
+			try:
+				self.watch()
+			except (pymongo.errors.OperationFailure, pymongo.errors.ConfigurationError, NotImplementedError, TypeError, AttributeError) as e:
+				# TypeError, AttributeError: clients without change streams, e.g. mongomock
+				print('reference_cache change streams unavailable, polling', e)
+				break
+			except pymongo.errors.PyMongoError as e:
+				print('reference_cache change stream error, reconnecting', e)
+				self.stop_event.wait(self.poll_interval_s)
+		self.poll()
+		return
+
+	def watch(self):
+		pipeline = [{'$match': {'ns.coll': {'$in': list(self.collections)}}}]
+		with self.db.db.watch(pipeline, max_await_time_ms = 1000) as stream:
+			self.mode = 'change stream'
+			self.invalidate() # anything changed before the stream opened
+			while not self.stop_event.is_set():
+				change = stream.try_next()
+				if change is not None:
+					self.invalidate(change.get('ns', {}).get('coll'))
+		return
+
+	def signal(self, collection):
+		"""
+		(newest _id, document count, newest history entry _id) of collection, read from the server
+		changes with any insert, delete or update made through DB_Handler, in any process
+		each is one short read, newest first on the _id index
+		"""
+		newest = self.db.db[collection].find_one({}, {'_id': 1}, sort = [('_id', -1)])
+		logged = self.db.audit.collection.find_one({'collection': collection}, {'_id': 1}, sort = [('_id', -1)])
+		return (
+			newest['_id'] if newest else None,
+			self.db.db[collection].estimated_document_count(),
+			logged['_id'] if logged else None
+		)
+
+	def poll(self):
+		self.mode = 'polling'
+		t_refresh = time.time()
+		signals = dict()
+		while not self.stop_event.wait(self.poll_interval_s):
+			if self.db.t_last_op != self.t_last_op:
+				self.t_last_op = self.db.t_last_op
+				self.invalidate()
+			for collection in self.collections:
+				try:
+					signal = self.signal(collection)
+				except pymongo.errors.PyMongoError as e:
+					print('reference_cache poll error', collection, e)
+					continue
+				if collection in signals and signals[collection] != signal:
+					self.invalidate(collection)
+				signals[collection] = signal
+			if time.time() - t_refresh > self.refresh_interval_s:
+				t_refresh = time.time()
+				self.invalidate()
+		return
+
+	def stop(self):
+		self.stop_event.set()
+		return
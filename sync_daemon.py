@@ -0,0 +1,235 @@
+"""
+continuous mongodb -> bigquery sync of new events
+events are read in _id order after a watermark kept in the sync_state collection,
+and streamed to bigquery in micro-batches with insert_rows_json, _id as the insertId
+rows still failing after max_retries batches are copied to the sync_dead_letter collection and skipped
+nothing is written back to the events themselves
+	python sync_daemon.py
+	python sync_daemon.py --once
+
+offline, with local stand-ins:
+	import mongomock, bigquery_fake, bigquery, sync_daemon
+	db = mongomock.MongoClient().datalogger
+	bigquery.client = bigquery_fake.FakeClient()
+	sync_daemon.SyncDaemon(db.events, db.sync_state, insert = bigquery.insert_rows).run_once()
+"""
+import time
+import datetime
+import argparse
+import threading
+import collections
+
+from bson.objectid import ObjectId
+
+import functions
+
+
+FIELDS = {'data': 0, 'history': 0, 'migrated_to_bigquery': 0}
+
+
+class SyncDaemon():
+	def __init__(self, events, state, insert = None, name = 'events', batch_size = 500, poll_interval_s = 5, settle_s = 10,
+			max_retries = 3, dead_letter = None):
+		"""
+		events: pymongo collection to read from
+		state: pymongo collection holding the watermark, one document per name
+		insert: insert(rows, row_ids) -> set of failed indexes, defaults to bigquery.insert_rows
+		settle_s: events younger than this are left for the next batch,
+			so one inserted late with a slightly older _id is not skipped
+		max_retries: batches a row may fail in before it is dead-lettered, so one bad row cannot stall the sync
+		dead_letter: pymongo collection for those rows, defaults to sync_dead_letter next to state
+		"""
+		if insert is None:
+			import bigquery
+			insert = bigquery.insert_rows
+		self.events = events
+		self.state = state
+		self.insert = insert
+		self.name = name
+		self.batch_size = batch_size
+		self.poll_interval_s = poll_interval_s
+		self.settle_s = settle_s
+		self.max_retries = max_retries
+		self.dead_letter = dead_letter if dead_letter is not None else state.database['sync_dead_letter']
+
+		self.stop_event = threading.Event()
+		self.batches = collections.deque(maxlen = 100) # (when, rows, seconds)
+		self.rows_total = 0
+		self.errors = 0
+		self.last_error = None
+		self.attempts = collections.Counter() # failed batches per _id, reset when the row syncs or is dead-lettered
+		self.dead_letters = 0
+		self.lag_s = None
+		self.t_start = time.time()
+		self.watermark = self.load_watermark()
+		return
+
+	def load_watermark(self):
+		doc = self.state.find_one({'_id': self.name})
+		if doc and doc.get('watermark'):
+			return doc['watermark']
+		return self.initial_watermark()
+
+	def initial_watermark(self):
+		""" just before the oldest event not migrated by migrate_mongodb_to_bigquery, None syncs everything """
+		first = self.events.find_one({'migrated_to_bigquery': {'$ne': True}}, {'_id': 1}, sort = [('_id', 1)])
+		if first is None:
+			last = self.events.find_one({}, {'_id': 1}, sort = [('_id', -1)])
+			return last['_id'] if last else None
+		return ObjectId.from_datetime(first['_id'].generation_time - datetime.timedelta(seconds = 1))
+
+	def save_watermark(self):
+		self.state.update_one(
+			{'_id': self.name},
+			{'$set': {
+				'watermark': self.watermark,
+				'updated': datetime.datetime.now(datetime.timezone.utc),
+				'metrics': self.metrics()
+			}},
+			upsert = True
+		)
+		return
+
+	def query(self):
+		settled = ObjectId.from_datetime(datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds = self.settle_s))
+		id_range = {'$lt': settled}
+		if self.watermark is not None:
+			id_range['$gt'] = self.watermark
+		# already migrated by migrate_mongodb_to_bigquery, which leaves the events after this watermark to the daemon
+		return {'_id': id_range, 'migrated_to_bigquery': {'$ne': True}}
+
+	def measure_lag(self):
+		""" seconds since the oldest event still waiting was created, 0 when caught up """
+		oldest = self.events.find_one(self.query(), {'_id': 1}, sort = [('_id', 1)])
+		if oldest is None:
+			self.lag_s = 0
+		else:
+			self.lag_s = (datetime.datetime.now(datetime.timezone.utc) - oldest['_id'].generation_time).total_seconds()
+		return self.lag_s
+
+	def run_once(self):
+		""" sync one micro-batch, returns the number of rows synced """
+		t0 = time.perf_counter()
+		docs = list(self.events.find(self.query(), FIELDS).sort('_id', 1).limit(self.batch_size))
+		if len(docs) <= 0:
+			self.measure_lag()
+			return 0
+
+		failed = self.insert([functions.event_doc_to_row(d) for d in docs], [str(d['_id']) for d in docs])
+		dead = set()
+		if failed:
+			self.errors += 1
+			self.last_error = f'{len(failed)} of {len(docs)} rows failed'
+			print('sync_daemon', self.last_error)
+			for i in failed:
+				self.attempts[docs[i]['_id']] += 1
+			dead = {i for i in failed if self.attempts[docs[i]['_id']] >= self.max_retries}
+			self.save_dead_letters([docs[i] for i in sorted(dead)])
+
+		# the watermark only moves past rows that made it or were dead-lettered,
+		# later ones are resent and deduplicated by insertId
+		retry = failed - dead
+		passed = docs[:min(retry)] if retry else docs
+		for d in passed:
+			self.attempts.pop(d['_id'], None)
+		synced = len(passed) - len(dead & set(range(len(passed))))
+
+		if passed:
+			self.watermark = passed[-1]['_id']
+			self.rows_total += synced
+		self.batches.append((datetime.datetime.now(), synced, time.perf_counter() - t0))
+		self.measure_lag()
+		self.save_watermark()
+		return len(passed)
+
+	def save_dead_letters(self, docs):
+		""" copy rows that failed max_retries times to the dead_letter collection, to fix and resend by hand """
+		if not docs:
+			return
+		now = datetime.datetime.now(datetime.timezone.utc)
+		for d in docs:
+			self.dead_letter.replace_one(
+				{'_id': d['_id']},
+				{'name': self.name, 'event': d, 'attempts': self.attempts[d['_id']], 'when': now},
+				upsert = True
+			)
+		self.dead_letters += len(docs)
+		print('sync_daemon dead-lettered', len(docs), 'rows', [str(d['_id']) for d in docs])
+		return
+
+	def metrics(self):
+		recent_rows = sum(b[1] for b in self.batches)
+		recent_s = sum(b[2] for b in self.batches)
+		return {
+			'watermark': str(self.watermark),
+			'rows': self.rows_total,
+			'batches': len(self.batches),
+			'rows/s recent': round(recent_rows / recent_s, 1) if recent_s > 0 else None,
+			'rows/s overall': round(self.rows_total / max(time.time() - self.t_start, 1e-6), 1),
+			'lag (s)': self.lag_s,
+			'errors': self.errors,
+			'last error': self.last_error,
+			'retrying': len(self.attempts),
+			'dead letters': self.dead_letters
+		}
+
+	def record_error(self, e):
+		self.errors += 1
+		self.last_error = str(e)
+		print('sync_daemon error', e)
+		return
+
+	def run_pending(self):
+		"""
+		sync what is pending and return, for --once
+		rows being retried are sent again until they sync or are dead-lettered
+		returns False if a batch raised, the watermark and metrics are saved either way
+		"""
+		ok = True
+		try:
+			while self.run_once() >= self.batch_size or self.attempts:
+				pass
+		except Exception as e:
+			self.record_error(e)
+			ok = False
+		self.save_watermark()
+		print('sync_daemon', self.metrics())
+		return ok
+
+	def run(self):
+		""" sync until stop(), full batches are followed immediately by the next one """
+		while not self.stop_event.is_set():
+			try:
+				n = self.run_once()
+			except Exception as e:
+				self.record_error(e)
+				n = 0
+			if n < self.batch_size:
+				print('sync_daemon', self.metrics())
+				self.stop_event.wait(self.poll_interval_s)
+		return
+
+	def stop(self):
+		self.stop_event.set()
+		return
+
+
+if __name__ == '__main__':
+	from db_mongo import DB_Handler
+
+	parser = argparse.ArgumentParser(description = 'sync new mongodb events to bigquery')
+	parser.add_argument('--batch-size', type = int, default = 500)
+	parser.add_argument('--poll-interval', type = float, default = 5)
+	parser.add_argument('--once', action = 'store_true', help = 'sync what is pending and exit')
+	args = parser.parse_args()
+
+	dbh = DB_Handler()
+	daemon = SyncDaemon(dbh.db.events, dbh.db.sync_state, batch_size = args.batch_size, poll_interval_s = args.poll_interval)
+	if args.once:
+		if not daemon.run_pending():
+			raise SystemExit(1)
+	else:
+		try:
+			daemon.run()
+		except KeyboardInterrupt:
+			daemon.stop()
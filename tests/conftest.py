@@ -0,0 +1,24 @@
+"""
+offline fixtures: mongomock instead of the mongodb cluster, bigquery_fake instead of bigquery
+	python -m pytest tests
+"""
+import os
+import sys
+
+import mongomock
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db_mongo
+
+
+class MockDB_Handler(db_mongo.DB_Handler):
+	""" DB_Handler on an in-memory mongomock client """
+	def get_client(self):
+		return mongomock.MongoClient()
+
+
+@pytest.fixture
+def dbh():
+	return MockDB_Handler()
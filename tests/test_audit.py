@@ -0,0 +1,39 @@
+import datetime
+
+from bson.objectid import ObjectId
+
+from audit import AuditLog
+
+
+def test_record_and_page(dbh):
+	audit = AuditLog(dbh.db, page_size = 2)
+	audit.ensure_indexes()
+	doc_id = ObjectId()
+	t0 = datetime.datetime(2025, 1, 1)
+	audit.record_many([audit.entry('tools', doc_id, {'SN': str(i)}, 'Jo', t0 + datetime.timedelta(minutes = i)) for i in range(5)])
+	audit.record('tools', ObjectId(), {'SN': 'other'})
+
+	assert audit.pages('tools', doc_id) == 3
+	first = audit.page('tools', doc_id)
+	assert [e['what'] for e in first] == [{'SN': '4'}, {'SN': '3'}]
+	assert first[0]['who'] == 'Jo'
+	assert [e['what'] for e in audit.page('tools', doc_id, 2)] == [{'SN': '0'}]
+	assert audit.last_updated('tools')[str(doc_id)] == t0 + datetime.timedelta(minutes = 4)
+
+
+def test_migrate_embedded_is_insert_only_and_rerunnable(dbh):
+	t0 = datetime.datetime(2025, 1, 1)
+	_id = dbh.db.tools.insert_one({'SN': '1', 'history': [{'what': {'SN': '1'}, 'when': t0, 'who': 'Al'}]}).inserted_id
+	audit = AuditLog(dbh.db)
+	audit.record_many([audit.entry('tools', _id, {'SN': '1'}, 'Al', t0)]) # moved by an interrupted run
+	assert audit.migrate_embedded('tools') == 0
+	assert 'history' not in dbh.db.tools.find_one({'_id': _id})
+	assert audit.collection.count_documents({}) == 1
+
+
+def test_capped_history_skips_ttl(dbh, monkeypatch):
+	audit = AuditLog(dbh.db, ttl_days = 30)
+	# mongomock has no capped collections, nor Collection.options
+	monkeypatch.setattr(type(audit.collection), 'options', lambda self: {'capped': True}, raising = False)
+	audit.ensure_indexes()
+	assert all('expireAfterSeconds' not in i for i in audit.collection.index_information().values())
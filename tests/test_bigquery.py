@@ -0,0 +1,54 @@
+import datetime
+
+import pytest
+
+import bigquery
+import bigquery_fake
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+	client = bigquery_fake.FakeClient(handler = lambda sql, params: [{'datalogger': 'A'}])
+	monkeypatch.setattr(bigquery, 'client', client)
+	monkeypatch.setattr(bigquery, 'table_name', lambda table = 'events': 'project.dataset.' + table)
+	return client
+
+
+def test_build_find_binds_values(fake_client):
+	sql, params = bigquery.build_find(
+		['datalogger', 'filename'],
+		where = [('datalogger', 'in', ['A', 'B']), ('date', '>=', '2024-06-09'), ('timestamp', '<', 5)],
+		order = [('timestamp', 'DESC')],
+		limit = 10
+	)
+	assert sql == (
+		"SELECT `datalogger`, `filename` FROM `project.dataset.events` "
+		"WHERE `datalogger` IN UNNEST(@w0) AND `date` >= @w1 AND `timestamp` < @w2 "
+		"ORDER BY `timestamp` DESC LIMIT @limit"
+	)
+	assert params == [
+		('w0', 'STRING', ('A', 'B')),
+		('w1', 'DATE', '2024-06-09'),
+		('w2', 'INT64', 5),
+		('limit', 'INT64', 10),
+	]
+
+
+def test_build_find_same_text_for_other_values(fake_client):
+	a, _ = bigquery.build_find(['*'], where = [('datalogger', '=', 'A')], limit = 5)
+	b, _ = bigquery.build_find(['*'], where = [('datalogger', '=', 'B')], limit = 50)
+	assert a == b
+	assert a.startswith('SELECT * FROM')
+
+
+def test_build_find_rejects_operators(fake_client):
+	with pytest.raises(ValueError):
+		bigquery.build_find(['*'], where = [('datalogger', '; DROP TABLE events; --', 'A')])
+
+
+def test_find_sends_parameters(fake_client):
+	rows = bigquery.find(['datalogger'], where = [('timestamp', '>', datetime.datetime(2024, 6, 9, tzinfo = datetime.timezone.utc))], limit = 1)
+	assert list(rows) == [{'datalogger': 'A'}]
+	sql, params, cache_hit = fake_client.queries[-1]
+	assert params == {'w0': datetime.datetime(2024, 6, 9, tzinfo = datetime.timezone.utc), 'limit': 1}
+	assert cache_hit is False
@@ -0,0 +1,73 @@
+import os
+
+from blob_cache import BlobCache
+
+
+class FakeBlob():
+	""" the parts of google.cloud.storage.Blob the cache uses """
+	def __init__(self, name, data, generation = 1):
+		self.name = name
+		self.data = data
+		self.size = len(data)
+		self.generation = generation
+		self.downloads = 0
+
+	def download_to_filename(self, filename):
+		self.downloads += 1
+		with open(filename, 'wb') as f:
+			f.write(self.data)
+
+	def reload(self):
+		pass
+
+
+def local(root, name):
+	return os.path.join(root, name.replace('/', os.sep))
+
+
+def test_hits_do_not_download(tmp_path):
+	cache = BlobCache(root = str(tmp_path), max_bytes = 1000)
+	blob = FakeBlob('a/1.csv', b'x' * 10)
+	assert cache.fetch(blob, local(tmp_path, blob.name))
+	assert cache.fetch(blob, local(tmp_path, blob.name))
+	assert blob.downloads == 1
+	assert cache.stats()['hits'] == 1
+
+
+def test_derived_files_count_toward_budget(tmp_path):
+	cache = BlobCache(root = str(tmp_path), max_bytes = 250, derived_suffixes = ('.parquet',))
+	first = FakeBlob('a/1.csv', b'x' * 100)
+	cache.fetch(first, local(tmp_path, first.name))
+	with open(local(tmp_path, first.name) + '.parquet', 'wb') as f:
+		f.write(b'y' * 100)
+	cache.fetch(first, local(tmp_path, first.name)) # a hit measures the derived file
+	assert cache.stats()['bytes'] == 200
+
+	second = FakeBlob('a/2.csv', b'x' * 100)
+	cache.fetch(second, local(tmp_path, second.name))
+	assert cache.stats()['bytes'] <= 250
+	assert not os.path.exists(local(tmp_path, first.name))
+	assert not os.path.exists(local(tmp_path, first.name) + '.parquet')
+
+
+def test_files_from_before_the_index_are_adopted(tmp_path):
+	os.makedirs(tmp_path / 'a')
+	(tmp_path / 'a' / 'old.csv').write_bytes(b'x' * 100)
+	(tmp_path / 'a' / 'old.csv.parquet').write_bytes(b'y' * 50)
+	cache = BlobCache(root = str(tmp_path), max_bytes = 1000, derived_suffixes = ('.parquet',))
+	assert cache.stats()['files'] == 1
+	assert cache.stats()['bytes'] == 150
+
+	blob = FakeBlob('a/old.csv', b'x' * 100)
+	cache.fetch(blob, local(tmp_path, blob.name))
+	assert blob.downloads == 0
+
+
+def test_adopted_files_of_another_size_are_downloaded(tmp_path):
+	os.makedirs(tmp_path / 'a')
+	(tmp_path / 'a' / 'old.csv').write_bytes(b'x' * 50) # truncated
+	cache = BlobCache(root = str(tmp_path), max_bytes = 1000)
+	blob = FakeBlob('a/old.csv', b'x' * 100)
+	cache.fetch(blob, local(tmp_path, blob.name))
+	assert blob.downloads == 1
+	assert os.path.getsize(local(tmp_path, blob.name)) == 100
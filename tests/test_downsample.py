@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import downsample
+
+
+def sessions_trace(n_sessions = 6, per_session = 50_000, rate_hz = 1000, gap_s = 1800, seed = 0):
+	""" sessions at rate_hz separated by idle gaps, with a few short dips """
+	rng = np.random.default_rng(seed)
+	t = np.concatenate([s * gap_s + np.arange(per_session) / rate_hz for s in range(n_sessions)])
+	current = rng.normal(10, 2, len(t))
+	current[rng.choice(len(t), 20, replace = False)] = -40
+	return pd.DataFrame({'t (s)': t, 'current (A)': current, 'voltage (V)': rng.normal(54, 0.5, len(t))})
+
+
+@pytest.mark.parametrize('mode', downsample.MODES)
+def test_budget_is_filled_across_idle_gaps(mode):
+	df = sessions_trace()
+	ys = ['current (A)', 'voltage (V)']
+	result, width = downsample.downsample(df, 't (s)', ys, max_points = 20_000, mode = mode)
+	points = len(result) * len(ys)
+	assert width is not None
+	assert downsample.FILL * 20_000 <= points <= 20_000
+
+
+def test_minmax_keeps_extremes():
+	df = sessions_trace()
+	result, _ = downsample.downsample(df, 't (s)', ['current (A)', 'voltage (V)'], max_points = 20_000)
+	assert (result['current (A)'] == -40).sum() == (df['current (A)'] == -40).sum()
+	assert result['voltage (V)'].max() == df['voltage (V)'].max()
+	assert result['t (s)'].is_monotonic_increasing
+
+
+def test_small_frames_are_returned_whole():
+	df = sessions_trace(n_sessions = 1, per_session = 100)
+	result, width = downsample.downsample(df, 't (s)', ['current (A)'], max_points = 1000)
+	assert width is None
+	assert len(result) == len(df)
+
+
+def test_min_width_is_respected():
+	df = sessions_trace(n_sessions = 2, per_session = 10_000)
+	result, width = downsample.downsample(df, 't (s)', ['current (A)'], max_points = 100_000, min_width = 1)
+	assert width >= 1
+	assert len(result) < len(df)
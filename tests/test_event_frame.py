@@ -0,0 +1,73 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import event
+
+
+def write_v6_csv(filename, n = 1000, seed = 0):
+	rng = np.random.default_rng(seed)
+	pd.DataFrame({
+		't (s)': np.arange(n) / 1000,
+		'VBUS (V)': rng.normal(54, 0.5, n).round(4),
+		'CURRENT (A)': rng.normal(10, 2, n).round(4),
+		'DIETEMP (deg C)': rng.normal(30, 1, n).round(3),
+		'ENERGY (J)': np.cumsum(rng.uniform(0, 1, n)),
+	}).to_csv(filename, index = False)
+	return filename
+
+
+def test_downcast_within_tolerance_only():
+	df = pd.DataFrame({
+		'voltage (V)': [54.1234, 12.5],
+		'current (A)': [1e6 + 0.3, 1.0], # float32 would lose the 0.3
+		'energy (J)': [1.5, 2.5],
+	})
+	df = event.downcast_floats(df)
+	assert df['voltage (V)'].dtype == 'float32'
+	assert df['current (A)'].dtype == 'float64'
+	assert df['energy (J)'].dtype == 'float64'
+
+
+def test_parquet_copy_is_reused_and_versioned(tmp_path, monkeypatch):
+	csv = write_v6_csv(str(tmp_path / '1.csv'))
+	first = event.read_event_frame(csv)
+	parquet = event.event_parquet_filename(csv)
+	assert os.path.exists(parquet)
+	assert first['energy (J)'].dtype == 'float64'
+	mtime = os.path.getmtime(parquet)
+
+	again = event.read_event_frame(csv)
+	assert os.path.getmtime(parquet) == mtime
+	pd.testing.assert_frame_equal(first, again)
+
+	# a new version of the conversion does not serve the old copy
+	monkeypatch.setattr(event, 'EVENT_FRAME_VERSION', event.EVENT_FRAME_VERSION + 1)
+	event.read_event_frame(csv)
+	assert pd.read_parquet(parquet).attrs['event_frame_version'] == event.EVENT_FRAME_VERSION
+
+
+def test_load_event_files_order_and_errors(tmp_path, monkeypatch):
+	import data_from_cloud
+	names = ['A/events/747511440.csv', 'A/events/747511500.csv', 'A/events/747511560.csv', 'A/events/747511620.csv']
+	local = dict()
+	for k, name in enumerate(names):
+		local[name] = write_v6_csv(str(tmp_path / name.split('/')[-1]), n = 100, seed = k)
+	with open(local[names[2]], 'w') as f:
+		f.write('') # parses to EmptyDataError
+
+	def downloads(blob_names, max_workers = 8):
+		""" completion order is not the order asked for, and one download fails """
+		for i in [3, 2, 1, 0]:
+			if i == 1:
+				yield i, blob_names[i], False, FileNotFoundError(blob_names[i])
+			else:
+				yield i, blob_names[i], local[blob_names[i]], None
+
+	monkeypatch.setattr(data_from_cloud, 'download_blobs_by_name', downloads)
+	dfs, errors = event.load_event_files(names, 'UTC')
+	assert [df['t (s)'].iloc[0] for df in dfs] == [event.timestamp_from_filename(names[i]) for i in (0, 3)]
+	assert [name for name, e in errors] == [names[1], names[2]]
+	assert isinstance(errors[0][1], FileNotFoundError)
+	assert isinstance(errors[1][1], pd.errors.EmptyDataError)
@@ -0,0 +1,32 @@
+import db_mongo
+import index_advisor
+from audit import AuditLog
+
+
+def declared_indexes(collection):
+	indexes = [[('_id', 1)]] + db_mongo.INDEXES.get(collection, [])
+	if collection == 'history':
+		indexes += AuditLog.INDEXES
+	return indexes
+
+
+def query_fields(query):
+	if isinstance(query, list):
+		query = next((stage['$match'] for stage in query if '$match' in stage), {})
+	return [k for k in query if not k.startswith('$')]
+
+
+def test_every_query_shape_has_an_index():
+	""" the first key of some declared index is filtered or sorted on, the explain run by index_advisor.py needs a server """
+	for name, collection, query, sort in index_advisor.QUERY_SHAPES:
+		if name in index_advisor.COLLSCAN_OK:
+			continue
+		fields = query_fields(query) + [k for k, d in sort or []]
+		assert any(keys[0][0] in fields for keys in declared_indexes(collection)), name
+
+
+def test_sync_daemon_query_shape_is_listed(dbh):
+	import sync_daemon
+	daemon = sync_daemon.SyncDaemon(dbh.db.events, dbh.db.sync_state, insert = lambda rows, row_ids: set())
+	shapes = {name: query for name, collection, query, sort in index_advisor.QUERY_SHAPES}
+	assert sorted(shapes['SyncDaemon.query batch']) == sorted(daemon.query())
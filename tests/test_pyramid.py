@@ -0,0 +1,27 @@
+import pandas as pd
+
+import pyramid
+
+
+def level_frame(files, t, energy_last):
+	return pd.DataFrame({'file': files, 't (s)': t, 'energy (J) last': energy_last})
+
+
+def test_raw_files_of_a_window_with_offsets():
+	names = ('a.csv', 'b.csv', 'c.csv')
+	overview = level_frame([0, 0, 1, 1, 2], [0, 10, 100, 110, 200], [5.0, 9.0, 12.0, 20.0, 21.0])
+	window = level_frame([1, 2], [110, 200], [20.0, 21.0])
+	files, offsets = pyramid.raw_files(names, window, overview)
+	assert files == ('b.csv', 'c.csv')
+	assert offsets == {'energy (J)': 9.0}
+
+
+def test_raw_files_of_an_empty_window():
+	overview = level_frame([0], [0], [1.0])
+	assert pyramid.raw_files(('a.csv',), overview.iloc[0:0], overview) == ((), {})
+
+
+def test_choose_level_keeps_the_budget():
+	level = pyramid.choose_level(3600, 2, 100_000)
+	assert 3600 / level * 2 * len(pyramid.AGGREGATIONS) <= 100_000
+	assert pyramid.choose_level(10, 2, 100_000) == pyramid.LEVELS[0]
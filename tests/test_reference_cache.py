@@ -0,0 +1,48 @@
+import time
+
+from reference_cache import ReferenceCache
+
+
+def wait_for(condition, timeout_s = 5):
+	t0 = time.time()
+	while not condition():
+		if time.time() - t0 > timeout_s:
+			return False
+		time.sleep(0.02)
+	return True
+
+
+def test_falls_back_to_polling(dbh):
+	cache = ReferenceCache(dbh, poll_interval_s = 0.05)
+	try:
+		assert wait_for(lambda: cache.mode == 'polling')
+		assert cache.thread.is_alive()
+	finally:
+		cache.stop()
+
+
+def test_polling_sees_writes_from_other_processes(dbh):
+	dbh.db.tools.insert_one({'datalogger': 'A'})
+	cache = ReferenceCache(dbh, poll_interval_s = 0.05)
+	try:
+		assert wait_for(lambda: cache.mode == 'polling')
+		assert cache.df('tools')['datalogger'].tolist() == ['A']
+		time.sleep(0.2) # a first signal is read
+
+		# written straight to the database, like another app process would, t_last_op is unchanged
+		dbh.db.tools.insert_one({'datalogger': 'B'})
+		assert wait_for(lambda: 'tools' in cache.stale)
+		assert sorted(cache.df('tools')['datalogger'].tolist()) == ['A', 'B']
+	finally:
+		cache.stop()
+
+
+def test_writes_through_handler_invalidate(dbh):
+	cache = ReferenceCache(dbh, watch = False, poll_interval_s = 60)
+	try:
+		assert cache.df('users').empty
+		dbh.insert('users', {'name': 'Jo'})
+		assert 'users' in cache.stale
+		assert cache.df('users')['name'].tolist() == ['Jo']
+	finally:
+		cache.stop()
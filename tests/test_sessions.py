@@ -0,0 +1,40 @@
+import pandas as pd
+
+import event
+
+
+def events_frame():
+	""" two sessions 600 s apart, the second one discharging then charging """
+	return pd.DataFrame({
+		'timestamp': [1000, 1010, 1020, 1630, 1640, 1650],
+		'duration': [5.0, 5.0, 5.0, 5.0, 5.0, 5.0],
+		'avgCurrent': [3.0, 4.0, 2.0, 5.0, -2.0, -1.0],
+		'energy': [1.0, 1.0, 1.0, 2.0, -1.0, -1.0],
+		'date': pd.to_datetime(['2025-01-01'] * 6).date,
+		'filename': [f'A/events/{i}.csv' for i in range(6)],
+	})
+
+
+def test_label_sessions():
+	df = event.label_sessions(events_frame(), timeout_s = 60)
+	assert df['session_id'].tolist() == [0, 0, 0, 1, 1, 1]
+	assert df['segment_id'].tolist() == [0, 0, 0, 1, 2, 2]
+	assert df['charging'].tolist() == [False, False, False, False, True, True]
+
+
+def test_first_event_is_in_a_session():
+	sessions = event.combine_adjacent_events(events_frame(), timeout_s = 60)
+	assert [len(s) for s in sessions] == [3, 3]
+
+
+def test_split_by_charging_matches_summarize_events():
+	df = events_frame()
+	split = event.split_events_by_charging(event.combine_adjacent_events(df, timeout_s = 60))
+	assert [dfi['filename'].tolist() for dfi in split] == [
+		['A/events/0.csv', 'A/events/1.csv', 'A/events/2.csv'],
+		['A/events/3.csv'],
+		['A/events/4.csv', 'A/events/5.csv'],
+	]
+	summary = event.summarize_events(df, 'UTC', timeout_s = 60)
+	pd.testing.assert_frame_equal(event.events_list_summarized(split, 'UTC'), summary)
+	assert summary['End timestamp'].tolist() == [1025.0, 1635.0, 1655.0]
@@ -0,0 +1,108 @@
+import datetime
+
+import pytest
+from bson.objectid import ObjectId
+
+import bigquery
+import bigquery_fake
+import sync_daemon
+
+
+def add_events(db, n):
+	""" n events old enough to be past settle_s, oldest first """
+	t0 = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours = 1)
+	ids = list()
+	for i in range(n):
+		date = t0 + datetime.timedelta(seconds = i)
+		_id = ObjectId.from_datetime(date)
+		# from_datetime leaves the rest zeroed, keep the ids unique and in order
+		_id = ObjectId(str(_id)[:8] + format(i, '016x'))
+		db.events.insert_one({'_id': _id, 'date': date.replace(tzinfo = None), 'datalogger': 'A', 'timestamp': 1000 + i})
+		ids.append(_id)
+	return ids
+
+
+class FlakyInsert():
+	""" insert(rows, row_ids) that fails the rows whose id is in bad, recording each call """
+	def __init__(self, bad = ()):
+		self.bad = set(bad)
+		self.calls = list()
+
+	def __call__(self, rows, row_ids):
+		self.calls.append(list(row_ids))
+		return {i for i, row_id in enumerate(row_ids) if row_id in self.bad}
+
+
+def test_batches_in_id_order(dbh):
+	ids = add_events(dbh.db, 7)
+	insert = FlakyInsert()
+	daemon = sync_daemon.SyncDaemon(dbh.db.events, dbh.db.sync_state, insert = insert, batch_size = 3)
+	assert daemon.run_pending()
+	assert [len(c) for c in insert.calls] == [3, 3, 1]
+	assert sum(insert.calls, []) == [str(i) for i in ids]
+	assert daemon.watermark == ids[-1]
+	assert dbh.db.sync_state.find_one({'_id': 'events'})['watermark'] == ids[-1]
+	assert daemon.metrics()['rows'] == 7
+
+	# a new daemon starts after the saved watermark
+	again = sync_daemon.SyncDaemon(dbh.db.events, dbh.db.sync_state, insert = FlakyInsert(), batch_size = 3)
+	assert again.run_once() == 0
+
+
+def test_migrated_events_are_skipped(dbh):
+	ids = add_events(dbh.db, 4)
+	dbh.db.events.update_many({'_id': {'$in': ids[:2]}}, {'$set': {'migrated_to_bigquery': True}})
+	insert = FlakyInsert()
+	sync_daemon.SyncDaemon(dbh.db.events, dbh.db.sync_state, insert = insert, batch_size = 10).run_pending()
+	assert sum(insert.calls, []) == [str(i) for i in ids[2:]]
+
+
+def test_failed_row_is_dead_lettered(dbh):
+	ids = add_events(dbh.db, 5)
+	insert = FlakyInsert(bad = {str(ids[2])})
+	daemon = sync_daemon.SyncDaemon(dbh.db.events, dbh.db.sync_state, insert = insert, batch_size = 10, max_retries = 3)
+
+	# the watermark stops before the failing row, so it and the rows after it are resent
+	daemon.run_once()
+	assert daemon.watermark == ids[1]
+	assert daemon.attempts[ids[2]] == 1
+	assert dbh.db.sync_dead_letter.count_documents({}) == 0
+
+	assert daemon.run_pending()
+	assert len(insert.calls) == 3
+	assert daemon.watermark == ids[-1]
+	assert not daemon.attempts
+	dead = list(dbh.db.sync_dead_letter.find())
+	assert [d['_id'] for d in dead] == [ids[2]]
+	assert dead[0]['attempts'] == 3
+	assert dead[0]['event']['timestamp'] == 1002
+	metrics = daemon.metrics()
+	assert metrics['dead letters'] == 1
+	assert metrics['rows'] == 4
+
+
+def test_duplicates_dropped_by_insert_id(dbh, monkeypatch):
+	""" rows resent after a partial failure are deduplicated by bigquery """
+	ids = add_events(dbh.db, 3)
+	client = bigquery_fake.FakeClient()
+	monkeypatch.setattr(bigquery, 'client', client, raising = False)
+	monkeypatch.setattr(bigquery, 'get_client', lambda: client)
+	monkeypatch.setattr(bigquery, 'table_name', lambda table: 'project.dataset.' + table)
+	daemon = sync_daemon.SyncDaemon(dbh.db.events, dbh.db.sync_state, insert = bigquery.insert_rows, batch_size = 10)
+	daemon.run_pending()
+	daemon.watermark = None
+	daemon.run_pending()
+	assert len(client.inserted['project.dataset.events']) == len(ids)
+
+
+def test_run_pending_error_saves_metrics(dbh):
+	add_events(dbh.db, 2)
+
+	def broken(rows, row_ids):
+		raise RuntimeError('bigquery unavailable')
+
+	daemon = sync_daemon.SyncDaemon(dbh.db.events, dbh.db.sync_state, insert = broken)
+	assert not daemon.run_pending()
+	state = dbh.db.sync_state.find_one({'_id': 'events'})
+	assert state['metrics']['errors'] == 1
+	assert state['metrics']['last error'] == 'bigquery unavailable'
@@ -0,0 +1,39 @@
+import math
+
+from db_mongo import updated_fields
+
+
+def test_unchanged_is_empty():
+	doc = {'name': 'drill', 'meta': {'a': 1, 'b': [1, 2]}, 'price': math.nan}
+	assert updated_fields(doc, {'name': 'drill', 'meta': {'a': 1, 'b': [1, 2]}, 'price': math.nan}) == {}
+
+
+def test_nested_dict_and_list_paths():
+	old = {'schedule': [{'User': 'Al', 'start': 1}, {'User': 'Bo', 'start': 2}], 'meta': {'a': 1}}
+	new = {'schedule': [{'User': 'Al', 'start': 1}, {'User': 'Jo', 'start': 2}], 'meta': {'a': 1, 'c': 3}}
+	assert updated_fields(old, new) == {'schedule.1.User': 'Jo', 'meta.c': 3}
+
+
+def test_lists_of_another_length_are_replaced():
+	assert updated_fields({'tags': [1, 2]}, {'tags': [1, 2, 3]}) == {'tags': [1, 2, 3]}
+
+
+def test_removed_nested_keys_replace_the_dict():
+	assert updated_fields({'meta': {'a': 1, 'b': 2}}, {'meta': {}}) == {'meta': {}}
+	assert updated_fields({'meta': {'x': {'a': 1, 'b': 2}}}, {'meta': {'x': {'a': 1}}}) == {'meta.x': {'a': 1}}
+
+
+def test_top_level_is_a_partial_update():
+	assert updated_fields({'name': 'drill', 'SN': '1'}, {'SN': '2'}) == {'SN': '2'}
+
+
+def test_history_is_excluded():
+	assert updated_fields({'history': []}, {'history': [{'what': 1}]}) == {}
+
+
+def test_update_writes_removed_keys_and_history(dbh):
+	_id = dbh.insert('tools', {'meta': {'a': 1, 'b': 2}})
+	assert dbh.update('tools', _id, {'meta': {}}) == {'meta': {}}
+	assert dbh.db.tools.find_one({'_id': _id})['meta'] == {}
+	# the insert and the update can share a millisecond, so their order is not checked
+	assert {'meta': {}} in [e['what'] for e in dbh.audit.page('tools', _id)]